@@ -1,10 +1,121 @@
 import pandas as pd
+import numpy as np
+import argparse
 import json
-from collections import Counter
+import os
+import struct
+import zlib
 
-df = pd.read_csv("metrics.csv")
+# Columnas que usa el resumen (el resto no se carga del formato binario)
+COLUMNAS_RESUMEN = [
+    "timestamp",
+    "event",
+    "request_id",
+    "status",
+    "extra_info",
+    "microservice_id",
+]
 
-summary = []
+
+def _decodificar_columna(tipo, crudo, n_filas, strings):
+    if tipo == "d":
+        return np.frombuffer(crudo, dtype="<f8")
+    if tipo == "q":
+        return np.frombuffer(crudo, dtype="<i8")
+    if tipo == "H":
+        tabla = np.array(strings, dtype=object)
+        return tabla[np.frombuffer(crudo, dtype="<u2")]
+    if tipo == "u":
+        # uuid en 16 bytes; ceros = "-" (evento sin request)
+        vacio = bytes(16)
+        return np.array(
+            [
+                "-" if crudo[i : i + 16] == vacio else crudo[i : i + 16].hex()
+                for i in range(0, len(crudo), 16)
+            ],
+            dtype=object,
+        )
+    # "s": offsets u32 * (n + 1) seguidos de los bytes utf-8
+    corte = 4 * (n_filas + 1)
+    offsets = np.frombuffer(crudo[:corte], dtype="<u4")
+    datos = crudo[corte:]
+    return np.array(
+        [datos[a:b].decode("utf-8") for a, b in zip(offsets[:-1], offsets[1:])],
+        dtype=object,
+    )
+
+
+def _iterar_bloques(directorio, columnas=None):
+    """Recorrer los segmentos binarios bloque a bloque como DataFrames.
+
+    Solo se decodifican las columnas pedidas; el resto se salta con seek.
+    Un bloque truncado al final de un segmento (escritura interrumpida) se
+    ignora.
+    """
+    pedidas = set(columnas) if columnas is not None else None
+
+    archivos = sorted(
+        nombre
+        for nombre in os.listdir(directorio)
+        if nombre.startswith("segment-") and nombre.endswith(".bin")
+    )
+    for nombre in archivos:
+        with open(os.path.join(directorio, nombre), "rb") as f:
+            while True:
+                cabecera = f.read(14)
+                if len(cabecera) < 14 or cabecera[:4] not in (b"MTB1", b"MTB2"):
+                    break
+                # MTB2: cada columna comprimida con zlib
+                comprimido = cabecera[:4] == b"MTB2"
+                n_filas, proc_id, n_strings = struct.unpack("<IIH", cabecera[4:])
+                strings = []
+                for _ in range(n_strings):
+                    (largo,) = struct.unpack("<H", f.read(2))
+                    strings.append(f.read(largo).decode("utf-8"))
+                directorio_columnas = []
+                for _ in range(f.read(1)[0]):
+                    largo = f.read(1)[0]
+                    nombre_col = f.read(largo).decode("utf-8")
+                    tipo, n_bytes = struct.unpack("<cI", f.read(5))
+                    directorio_columnas.append((nombre_col, tipo.decode(), n_bytes))
+
+                bloque = {}
+                completo = True
+                for nombre_col, tipo, n_bytes in directorio_columnas:
+                    if pedidas is not None and nombre_col not in pedidas:
+                        f.seek(n_bytes, os.SEEK_CUR)
+                        continue
+                    crudo = f.read(n_bytes)
+                    if len(crudo) < n_bytes:
+                        completo = False
+                        break
+                    if comprimido:
+                        crudo = zlib.decompress(crudo)
+                    bloque[nombre_col] = _decodificar_columna(
+                        tipo, crudo, n_filas, strings
+                    )
+                if not completo:
+                    break
+                if pedidas is None or "proc_id" in pedidas:
+                    bloque["proc_id"] = np.full(n_filas, proc_id, dtype="<i8")
+
+                df = pd.DataFrame(bloque)
+                if "microservice_id" in df:
+                    # Igual que en el CSV: "-" cuando no aplica, el id como texto
+                    df["microservice_id"] = np.where(
+                        df["microservice_id"] < 0,
+                        "-",
+                        df["microservice_id"].astype(str),
+                    )
+                yield df
+
+
+def leer_segmentos(directorio, columnas=None):
+    """Leer los segmentos binarios de métricas (formato en validador/metrics_log.py)."""
+    bloques = list(_iterar_bloques(directorio, columnas))
+    if not bloques:
+        return pd.DataFrame(columns=columnas)
+    return pd.concat(bloques, ignore_index=True)
 
 
 def try_parse_json(value):
@@ -18,116 +129,399 @@ def try_parse_json(value):
 # Alias para microservicios
 alias_map = {1: "MS1", 2: "MS2", 3: "MS3", "1": "MS1", "2": "MS2", "3": "MS3"}
 
-for request_id, group in df.groupby("request_id"):
-    if request_id == "-":  # ignorar eventos sin request
-        continue
+COLUMNAS_SALIDA = [
+    "id_peticion",
+    "tiempo_inicio",
+    "tiempo_fin",
+    "latencia_total",
+    "microservicios_respondieron",
+    "microservicios_discrepantes",
+    "consenso_alcanzado",
+    "id_producto",
+    "en_stock",
+    "cantidad_producto",
+]
 
-    tiempo_inicio = group["timestamp"].min()
-    tiempo_fin = group["timestamp"].max()
-    latencia_total = tiempo_fin - tiempo_inicio
+
+def _alias(serie):
+    return serie.map(lambda ms: alias_map.get(ms, str(ms)))
+
+
+def _unir(serie, claves):
+    """ ", ".join por request (en orden de llegada), "" si no hay filas."""
+    if serie.empty:
+        return pd.Series("", index=claves, dtype=object)
+    unidos = serie.groupby(level=0, sort=False).agg(", ".join)
+    return unidos.reindex(claves, fill_value="")
+
+
+def _columna_objeto(valores, indice):
+    # dtype object con None (no NaN) para que CSV y HTML no cambien
+    return pd.Series(np.array(valores, dtype=object), index=indice, dtype=object)
+
+
+def resumir_peticiones(df):
+    """Resumen por request con operaciones sobre todo el DataFrame.
+
+    Devuelve las mismas filas y valores que el antiguo bucle por grupo:
+    latencias por min/max, respondedores y voto por groupby, y el valor de
+    consenso como la clave (product_id, in_stock, quantity) más frecuente,
+    desempatando por la primera en aparecer (igual que Counter.most_common).
+    """
+    df = df[df["request_id"] != "-"]  # ignorar eventos sin request
+    df = df[df["request_id"].notna()].reset_index(drop=True)
+
+    tiempos = df.groupby("request_id")["timestamp"].agg(["min", "max"])
+    claves = tiempos.index
 
     # Microservicios que respondieron
-    respondieron = group[group["event"] == "response_received"][
-        "microservice_id"
-    ].tolist()
-    respondieron_alias = [alias_map.get(ms, str(ms)) for ms in respondieron]
+    recibidas = df[df["event"] == "response_received"]
+    respondieron = _alias(recibidas["microservice_id"])
+    respondieron.index = recibidas["request_id"]
+    respondieron_txt = _unir(respondieron, claves)
 
-    # Info de votación
-    fila_voto = group[group["event"] == "vote_result"]
-    consenso_alcanzado = (
-        not fila_voto.empty and fila_voto["status"].iloc[0] == "consensus_reached"
+    # Info de votación (primera fila vote_result de cada request)
+    votos = df[df["event"] == "vote_result"].drop_duplicates("request_id", keep="first")
+    consenso = (
+        (votos.set_index("request_id")["status"] == "consensus_reached")
+        .reindex(claves, fill_value=False)
+        .astype(bool)
     )
 
-    # Extraer respuestas
-    respuestas = group[group["event"] == "microservice_response"][
-        ["microservice_id", "extra_info"]
+    # Extraer respuestas: un solo recorrido para parsear el JSON
+    respuestas = df[df["event"] == "microservice_response"]
+    parseadas = [try_parse_json(v) for v in respuestas["extra_info"].to_numpy()]
+    es_dict = np.fromiter(
+        (isinstance(p, dict) for p in parseadas), dtype=bool, count=len(parseadas)
+    )
+    datos = [p.get("data", {}) for p, ok in zip(parseadas, es_dict) if ok]
+    respuestas = pd.DataFrame(
+        {
+            "request_id": respuestas["request_id"].to_numpy()[es_dict],
+            "microservice_id": _alias(respuestas["microservice_id"]).to_numpy()[
+                es_dict
+            ],
+            "clave": pd.Series(
+                [
+                    (d.get("product_id"), d.get("in_stock"), d.get("quantity"))
+                    for d in datos
+                ],
+                dtype=object,
+            ),
+        }
+    )
+    respuestas["orden"] = np.arange(len(respuestas))
+
+    # Valor más común por request: frecuencia desc, primera aparición asc
+    conteos = (
+        respuestas.groupby(["request_id", "clave"], sort=False)["orden"]
+        .agg(["size", "min"])
+        .reset_index()
+        .sort_values(["size", "min"], ascending=[False, True], kind="stable")
+        .drop_duplicates("request_id", keep="first")
+        .set_index("request_id")
+    )
+    con_valores = pd.Series(claves.isin(conteos.index), index=claves)
+    frecuencia = conteos["size"].reindex(claves, fill_value=0)
+    sin_consenso = con_valores & (frecuencia == 1)
+    con_consenso = con_valores & (frecuencia > 1)
+
+    # Discrepantes: los que no coinciden con el valor consensuado
+    respuestas["moda"] = respuestas["request_id"].map(conteos["clave"])
+    discrepan = respuestas[respuestas["clave"] != respuestas["moda"]].set_index(
+        "request_id"
+    )["microservice_id"]
+    discrepantes_txt = _unir(discrepan, claves)
+    discrepantes_txt = discrepantes_txt.where(
+        con_consenso, respondieron_txt.where(sin_consenso | ~consenso, "")
+    )
+
+    # Valores de consenso (None si no hubo respuestas parseables)
+    moda = conteos["clave"].reindex(claves)
+    campos = [[None] * len(claves) for _ in range(3)]
+    for posicion in np.flatnonzero(con_consenso.to_numpy()):
+        for i, valor in enumerate(moda.iloc[posicion]):
+            campos[i][posicion] = valor
+    for posicion in np.flatnonzero(sin_consenso.to_numpy()):
+        for i in range(3):
+            campos[i][posicion] = "Sin consenso"
+    consenso = consenso & ~sin_consenso
+
+    return pd.DataFrame(
+        {
+            "id_peticion": claves.to_numpy(),
+            "tiempo_inicio": tiempos["min"].to_numpy(),
+            "tiempo_fin": tiempos["max"].to_numpy(),
+            "latencia_total": (tiempos["max"] - tiempos["min"]).to_numpy(),
+            "microservicios_respondieron": respondieron_txt.to_numpy(),
+            "microservicios_discrepantes": discrepantes_txt.to_numpy(),
+            "consenso_alcanzado": np.where(consenso.to_numpy(), "Sí", "No"),
+            "id_producto": _columna_objeto(campos[0], range(len(claves))),
+            "en_stock": _columna_objeto(campos[1], range(len(claves))),
+            "cantidad_producto": _columna_objeto(campos[2], range(len(claves))),
+        },
+        columns=COLUMNAS_SALIDA,
+    )
+
+
+def ordenar_resumen(summary_df):
+    # Ordenar por id_peticion (ids numéricos de logs antiguos)
+    summary_df["id_peticion"] = pd.to_numeric(
+        summary_df["id_peticion"], errors="ignore"
+    )
+    if summary_df["id_peticion"].dtype == object:
+        # Ids uuid (correlation_id): ordenar por llegada
+        return summary_df.sort_values(
+            by=["tiempo_inicio", "id_peticion"], kind="stable"
+        ).reset_index(drop=True)
+    return summary_df.sort_values(by="id_peticion").reset_index(drop=True)
+
+
+def colorear_html(html_table):
+    # Pintar en rojo solo los "No"
+    rows = html_table.split("<tr>")
+    for i, row in enumerate(rows):
+        if "<td>No</td>" in row:
+            rows[i] = f"<tr style='background-color:#ffcccc'>{row}"
+        elif row.strip() != "":
+            rows[i] = "<tr>" + row
+
+    return "<tr>".join(rows)
+
+
+def generar_reportes(df, ruta_csv, ruta_html):
+    # --- Crear DataFrame resumen ---
+    summary_df = ordenar_resumen(resumir_peticiones(df))
+
+    # Guardar CSV
+    summary_df.to_csv(ruta_csv, index=False)
+
+    # Generar HTML con estilo
+    html = colorear_html(summary_df.to_html(index=False, escape=False))
+
+    with open(ruta_html, "w", encoding="utf-8") as f:
+        f.write(html)
+
+
+# Tramos que el validador registra en los eventos "stage_timing", en el
+# orden del recorrido de un mensaje; "total" va de publicar a recibir
+ETAPAS = [
+    "request_queue",
+    "worker_wait",
+    "processing",
+    "db",
+    "respond",
+    "response_queue",
+    "total",
+]
+
+COLUMNAS_ETAPAS = [
+    "instancia",
+    "etapa",
+    "n",
+    "media_ms",
+    "p50_ms",
+    "p95_ms",
+    "p99_ms",
+    "max_ms",
+    "porcentaje_total",
+]
+
+
+def filas_etapas(bloques):
+    """Solo los eventos stage_timing de una secuencia de bloques del log"""
+    filtrados = [
+        bloque.loc[
+            bloque["event"] == "stage_timing",
+            ["request_id", "microservice_id", "extra_info"],
+        ]
+        for bloque in bloques
     ]
+    if not filtrados:
+        return pd.DataFrame(columns=["request_id", "microservice_id", "extra_info"])
+    return pd.concat(filtrados, ignore_index=True)
 
-    valores_relevantes = []
-    for _, row in respuestas.iterrows():
-        parsed = try_parse_json(row["extra_info"])
-        if isinstance(parsed, dict):
-            data = parsed.get("data", {})
-            valores_relevantes.append(
-                {
-                    "microservice_id": alias_map.get(
-                        row["microservice_id"], str(row["microservice_id"])
-                    ),
-                    "clave": (
-                        data.get("product_id"),
-                        data.get("in_stock"),
-                        data.get("quantity"),
-                    ),
-                }
-            )
 
-    # Determinar consenso y discrepantes
-    id_producto = en_stock = cantidad_producto = None
-    microservicios_discrepantes = []
+def desglose_etapas(df):
+    """Latencia por tramo e instancia a partir de los eventos stage_timing.
 
-    if valores_relevantes:
-        conteos = Counter([v["clave"] for v in valores_relevantes])
-        valor_mas_comun, frecuencia = conteos.most_common(1)[0]
+    Cada evento trae en extra_info los tramos (ms) de una respuesta. Se
+    reportan percentiles por (instancia, etapa), más las filas "todas", y
+    qué parte de la media del total representa cada tramo.
+    """
+    eventos = df[df["event"] == "stage_timing"] if "event" in df else df
+    tramos = pd.DataFrame(
+        [try_parse_json(valor) or {} for valor in eventos["extra_info"]],
+        columns=ETAPAS,
+    )
+    if tramos.empty:
+        return pd.DataFrame(columns=COLUMNAS_ETAPAS)
+    tramos["instancia"] = _alias(eventos["microservice_id"].astype(str)).values
 
-        if frecuencia == 1:
-            # Todos difieren → no hay consenso
-            microservicios_discrepantes = respondieron_alias
-            id_producto = en_stock = cantidad_producto = "Sin consenso"
-            consenso_alcanzado = False
-        else:
-            # Tomar valor consensuado
-            id_producto, en_stock, cantidad_producto = valor_mas_comun
-            # Detectar discrepantes (los que no coinciden con el consenso)
-            microservicios_discrepantes = [
-                v["microservice_id"]
-                for v in valores_relevantes
-                if v["clave"] != valor_mas_comun
-            ]
-    else:
-        if not consenso_alcanzado:
-            microservicios_discrepantes = respondieron_alias
+    largo = pd.concat(
+        [tramos, tramos.assign(instancia="todas")], ignore_index=True
+    ).melt(id_vars="instancia", var_name="etapa", value_name="ms")
+    largo = largo.dropna(subset=["ms"])
+    largo["ms"] = largo["ms"].astype(float)
 
-    summary.append(
-        {
-            "id_peticion": request_id,
-            "tiempo_inicio": tiempo_inicio,
-            "tiempo_fin": tiempo_fin,
-            "latencia_total": latencia_total,
-            "microservicios_respondieron": ", ".join(respondieron_alias),
-            "microservicios_discrepantes": ", ".join(microservicios_discrepantes),
-            "consenso_alcanzado": "Sí" if consenso_alcanzado else "No",
-            "id_producto": id_producto,
-            "en_stock": en_stock,
-            "cantidad_producto": cantidad_producto,
-        }
+    agrupado = largo.groupby(["instancia", "etapa"])["ms"]
+    resumen = agrupado.agg(n="count", media_ms="mean", max_ms="max")
+    for nombre, q in (("p50_ms", 0.50), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+        resumen[nombre] = agrupado.quantile(q)
+    resumen = resumen.reset_index()
+
+    totales = resumen[resumen["etapa"] == "total"].set_index("instancia")["media_ms"]
+    resumen["porcentaje_total"] = (
+        resumen["media_ms"] / resumen["instancia"].map(totales) * 100.0
+    )
+    resumen["etapa"] = pd.Categorical(resumen["etapa"], ETAPAS, ordered=True)
+    resumen = resumen.sort_values(["instancia", "etapa"]).reset_index(drop=True)
+    resumen["etapa"] = resumen["etapa"].astype(str)
+    return resumen[COLUMNAS_ETAPAS].round(3)
+
+
+def _bloques_csv(ruta, filas_por_bloque):
+    # request_id como texto para que un mismo id agrupe igual en todos los bloques
+    return pd.read_csv(
+        ruta,
+        chunksize=filas_por_bloque,
+        usecols=COLUMNAS_RESUMEN,
+        dtype={"request_id": str, "microservice_id": str},
     )
 
-# --- Crear DataFrame resumen ---
-summary_df = pd.DataFrame(summary)
 
-# Ordenar por id_peticion
-summary_df["id_peticion"] = pd.to_numeric(summary_df["id_peticion"], errors="ignore")
-summary_df = summary_df.sort_values(by="id_peticion").reset_index(drop=True)
+def _bloques_segmentos(directorio, filas_por_bloque):
+    acumulado = []
+    filas = 0
+    for bloque in _iterar_bloques(directorio, COLUMNAS_RESUMEN):
+        acumulado.append(bloque)
+        filas += len(bloque)
+        if filas >= filas_por_bloque:
+            yield pd.concat(acumulado, ignore_index=True)
+            acumulado = []
+            filas = 0
+    if acumulado:
+        yield pd.concat(acumulado, ignore_index=True)
+
 
-# Guardar CSV
-summary_df.to_csv("metrics_summary.csv", index=False)
+def generar_reportes_streaming(bloques, ruta_csv, ruta_html, gracia):
+    """Resumen por bloques con memoria acotada por las requests en vuelo.
 
-# Generar HTML con estilo
-html_table = summary_df.to_html(index=False, escape=False)
+    Las filas de una request se arrastran entre bloques hasta que pasa
+    `gracia` segundos (según los timestamps del log) sin eventos nuevos de
+    ella; entonces se resume y se agrega al CSV y al HTML. Al final se
+    resume lo que quede pendiente. El orden es por id dentro de cada tanda.
+    """
+    pendientes = None
+    primera = True
 
-# Pintar en rojo solo los "No"
-rows = html_table.split("<tr>")
-for i, row in enumerate(rows):
-    if "<td>No</td>" in row:
-        rows[i] = f"<tr style='background-color:#ffcccc'>{row}"
-    elif row.strip() != "":
-        rows[i] = "<tr>" + row
+    cabecera = pd.DataFrame(columns=COLUMNAS_SALIDA).to_html(index=False)
+    inicio_html = cabecera[: cabecera.index("<tbody>") + len("<tbody>")]
 
-html = "<tr>".join(rows)
+    with open(ruta_html, "w", encoding="utf-8") as html:
+        html.write(colorear_html(inicio_html))
 
-with open("metrics_summary.html", "w", encoding="utf-8") as f:
-    f.write(html)
+        def escribir(filas):
+            nonlocal primera
+            if filas.empty:
+                return
+            resumen = ordenar_resumen(resumir_peticiones(filas))
+            resumen.to_csv(
+                ruta_csv, index=False, mode="w" if primera else "a", header=primera
+            )
+            primera = False
+            tabla = resumen.to_html(index=False, escape=False)
+            cuerpo = tabla[
+                tabla.index("<tbody>") + len("<tbody>") : tabla.index("</tbody>")
+            ]
+            html.write(colorear_html(cuerpo))
 
-print(
-    "Generados: metrics_summary.csv y metrics_summary.html (con MS1, MS2, MS3 en columnas)"
-)
+        for bloque in bloques:
+            bloque = bloque[
+                bloque["request_id"].notna() & (bloque["request_id"] != "-")
+            ]
+            if pendientes is not None:
+                bloque = pd.concat([pendientes, bloque], ignore_index=True)
+            if bloque.empty:
+                continue
+
+            # Terminadas: sin eventos en los últimos `gracia` segundos del log
+            ultimo = bloque.groupby("request_id")["timestamp"].transform("max")
+            terminadas = ultimo < bloque["timestamp"].max() - gracia
+            escribir(bloque[terminadas])
+            pendientes = bloque[~terminadas]
+
+        if pendientes is not None:
+            escribir(pendientes)
+        html.write("</tbody>\n</table>")
+
+    if primera:
+        pd.DataFrame(columns=COLUMNAS_SALIDA).to_csv(ruta_csv, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resumen de metrics.csv")
+    parser.add_argument(
+        "--segmentos",
+        metavar="DIR",
+        help="leer el log binario (metrics_segments/) en lugar de metrics.csv",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="procesar el log por bloques sin cargarlo entero en memoria",
+    )
+    parser.add_argument(
+        "--filas-por-bloque",
+        type=int,
+        default=200000,
+        help="filas leídas por bloque en modo streaming",
+    )
+    parser.add_argument(
+        "--gracia",
+        type=float,
+        default=60.0,
+        help="segundos sin eventos tras los que una request se da por cerrada",
+    )
+    parser.add_argument(
+        "--etapas",
+        action="store_true",
+        help="además, desglose de latencia por tramo e instancia (metrics_etapas.csv)",
+    )
+    args = parser.parse_args()
+
+    if args.streaming:
+        if args.segmentos:
+            bloques = _bloques_segmentos(args.segmentos, args.filas_por_bloque)
+        else:
+            bloques = _bloques_csv("metrics.csv", args.filas_por_bloque)
+        generar_reportes_streaming(
+            bloques, "metrics_summary.csv", "metrics_summary.html", args.gracia
+        )
+    else:
+        if args.segmentos:
+            df = leer_segmentos(args.segmentos, COLUMNAS_RESUMEN)
+        else:
+            df = pd.read_csv("metrics.csv")
+        generar_reportes(df, "metrics_summary.csv", "metrics_summary.html")
+
+    print(
+        "Generados: metrics_summary.csv y metrics_summary.html (con MS1, MS2, MS3 en columnas)"
+    )
+
+    if args.etapas:
+        # Solo se conservan los eventos stage_timing de cada bloque
+        columnas = ["event", "request_id", "microservice_id", "extra_info"]
+        if args.segmentos:
+            bloques = _iterar_bloques(args.segmentos, columnas)
+        else:
+            bloques = pd.read_csv(
+                "metrics.csv",
+                chunksize=args.filas_por_bloque,
+                usecols=columnas,
+                dtype={"request_id": str, "microservice_id": str},
+            )
+        etapas = desglose_etapas(filas_etapas(bloques))
+        etapas.to_csv("metrics_etapas.csv", index=False)
+        print(etapas.to_string(index=False))
+        print("Generado: metrics_etapas.csv")
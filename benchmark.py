@@ -0,0 +1,378 @@
+"""Benchmark de punta a punta sin Docker.
+
+Levanta en un solo proceso el validador (app Flask real) y las tres
+instancias de inventario (consumidor y pool de workers reales, SQLite
+inicializada con init_db.py) unidos por el LocalBus de local_stack.py.
+Luego carga /process con concurrencia fija (lazo cerrado) o
+con una tasa de llegadas de Poisson (lazo abierto) y reporta throughput,
+latencias p50/p95/p99, tasa de consenso y el desglose por etapa.
+
+    python benchmark.py --concurrencia 32 --duracion 20 --guardar base.json
+    python benchmark.py --tasa 200 --duracion 20 --comparar base.json
+
+Con --url se carga un validador ya levantado (p. ej. docker-compose) y solo
+se reportan las latencias vistas por el cliente.
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import local_stack
+
+# Métricas que se comparan contra la baseline: (ruta, mayor_es_mejor)
+METRICAS_COMPARADAS = [
+    (("throughput",), True),
+    (("tasa_consenso",), True),
+    (("latencia_ms", "p50"), False),
+    (("latencia_ms", "p95"), False),
+    (("latencia_ms", "p99"), False),
+]
+
+# Variables de entorno que cambian el resultado; se guardan con la config
+# para que --comparar avise si la baseline corrió con otras
+VARIABLES_ENTORNO = (
+    "COALESCE_REQUESTS",
+    "QUERY_CACHE_",
+    "HEDGED_DISPATCH",
+    "HEDGE_",
+    "QUORUM_",
+    "ADAPTIVE_DEADLINES",
+    "DEADLINE_",
+    "CIRCUIT_BREAKER",
+    "MESSAGE_ENCODING",
+    "PUBLISHER_CONFIRMS",
+    "TRANSIENT_MESSAGES",
+    "PRODUCT_CACHE_TTL",
+    "INVENTARIO_",
+)
+
+
+# --- Generación de carga ---
+
+
+def cliente_local(validador):
+    """Una petición por el test client de Flask (sin red)"""
+    locales = threading.local()
+
+    def enviar(payload):
+        if not hasattr(locales, "cliente"):
+            locales.cliente = validador.app.test_client()
+        respuesta = locales.cliente.post("/process", json=payload)
+        return respuesta.status_code
+
+    return enviar
+
+
+def cliente_http(url):
+    def enviar(payload):
+        peticion = urllib.request.Request(
+            url.rstrip("/") + "/process",
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(peticion, timeout=30) as respuesta:
+                respuesta.read()
+                return respuesta.status
+        except urllib.error.HTTPError as e:
+            return e.code
+        except Exception:
+            return 0
+
+    return enviar
+
+
+def ejecutar_carga(enviar, productos, concurrencia, duracion, tasa, semilla):
+    """Devuelve [(inicio, latencia, status)] de las peticiones completadas.
+
+    Sin tasa, `concurrencia` hilos envían una petición tras otra. Con tasa,
+    las llegadas siguen un proceso de Poisson y la latencia se mide desde la
+    llegada programada, así la espera por falta de hilos también cuenta.
+    """
+    azar = random.Random(semilla)
+    cargas = [{"product_id": p} for p in productos]
+    resultados = []
+    lock = threading.Lock()
+    fin = time.perf_counter() + duracion
+
+    def una(payload, llegada):
+        status = enviar(payload)
+        ahora = time.perf_counter()
+        with lock:
+            resultados.append((llegada, ahora - llegada, status))
+
+    if tasa:
+        with ThreadPoolExecutor(max_workers=concurrencia) as pool:
+            llegada = time.perf_counter()
+            while True:
+                llegada += azar.expovariate(tasa)
+                if llegada >= fin:
+                    break
+                espera = llegada - time.perf_counter()
+                if espera > 0:
+                    time.sleep(espera)
+                pool.submit(una, azar.choice(cargas), llegada)
+    else:
+
+        def bucle(indice):
+            local = random.Random(semilla * 1000 + indice)
+            while time.perf_counter() < fin:
+                una(local.choice(cargas), time.perf_counter())
+
+        hilos = [threading.Thread(target=bucle, args=(i,)) for i in range(concurrencia)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+    return resultados
+
+
+# --- Reporte y baseline ---
+
+
+def _percentiles(valores_s):
+    if not valores_s:
+        return {"n": 0}
+    ms = np.asarray(valores_s) * 1000.0
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {
+        "n": int(ms.size),
+        "media": round(float(ms.mean()), 3),
+        "p50": round(float(p50), 3),
+        "p95": round(float(p95), 3),
+        "p99": round(float(p99), 3),
+        "max": round(float(ms.max()), 3),
+    }
+
+
+def entorno_relevante():
+    """Valores de VARIABLES_ENTORNO (nombres exactos o prefijos) en este proceso"""
+    return {
+        k: v
+        for k, v in sorted(os.environ.items())
+        if any(k.startswith(nombre) for nombre in VARIABLES_ENTORNO)
+    }
+
+
+def resumir(resultados, duracion, etapas, config):
+    statuses = collections.Counter(str(s) for _, _, s in resultados)
+    total = len(resultados)
+    return {
+        "config": config,
+        "peticiones": total,
+        "duracion": duracion,
+        "throughput": round(total / duracion, 3) if duracion else 0.0,
+        "tasa_consenso": round(statuses.get("200", 0) / total, 4) if total else 0.0,
+        "status": dict(statuses),
+        "latencia_ms": _percentiles([latencia for _, latencia, _ in resultados]),
+        "etapas_ms": {
+            etapa: _percentiles(valores) for etapa, valores in sorted(etapas.items())
+        },
+    }
+
+
+def imprimir(resumen, salida=None):
+    print(
+        f"Peticiones: {resumen['peticiones']} en {resumen['duracion']:.1f}s "
+        f"-> {resumen['throughput']:.1f} req/s",
+        file=salida,
+    )
+    print(
+        f"Consenso: {resumen['tasa_consenso'] * 100:.1f}%  Status: {resumen['status']}",
+        file=salida,
+    )
+    filas = [("total", resumen["latencia_ms"])] + list(resumen["etapas_ms"].items())
+    print(
+        f"{'etapa':<16}{'n':>8}{'media':>10}{'p50':>10}{'p95':>10}{'p99':>10}",
+        file=salida,
+    )
+    for etapa, p in filas:
+        if not p.get("n"):
+            continue
+        print(
+            f"{etapa:<16}{p['n']:>8}{p['media']:>10.2f}{p['p50']:>10.2f}"
+            f"{p['p95']:>10.2f}{p['p99']:>10.2f}",
+            file=salida,
+        )
+
+
+def comparar(resumen, baseline, tolerancia, salida=None):
+    """Imprimir la comparación y devolver True si hay alguna regresión"""
+    regresion = False
+    print(
+        f"Comparación contra baseline (tolerancia {tolerancia * 100:.0f}%):",
+        file=salida,
+    )
+    if baseline.get("config") != resumen.get("config"):
+        print(
+            f"  aviso: la baseline usó otra configuración: {baseline.get('config')}",
+            file=salida,
+        )
+    for ruta, mayor_es_mejor in METRICAS_COMPARADAS:
+        actual, base = resumen, baseline
+        for clave in ruta:
+            actual = actual.get(clave, {}) if isinstance(actual, dict) else None
+            base = base.get(clave, {}) if isinstance(base, dict) else None
+        if not isinstance(actual, (int, float)) or not isinstance(base, (int, float)):
+            continue
+        cambio = (actual - base) / base if base else 0.0
+        empeora = -cambio if mayor_es_mejor else cambio
+        marca = "REGRESIÓN" if empeora > tolerancia else "ok"
+        regresion = regresion or empeora > tolerancia
+        print(
+            f"  {'.'.join(ruta):<16}{base:>12.3f}{actual:>12.3f}{cambio * 100:>+9.1f}%  {marca}",
+            file=salida,
+        )
+    return regresion
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de /process")
+    parser.add_argument(
+        "--concurrencia",
+        type=int,
+        default=16,
+        help="peticiones simultáneas (hilos cliente)",
+    )
+    parser.add_argument(
+        "--tasa",
+        type=float,
+        default=0.0,
+        help="llegadas por segundo (Poisson); 0 = lazo cerrado",
+    )
+    parser.add_argument(
+        "--duracion", type=float, default=10.0, help="segundos de medición"
+    )
+    parser.add_argument(
+        "--calentamiento",
+        type=float,
+        default=2.0,
+        help="segundos de carga previos que no se miden",
+    )
+    parser.add_argument(
+        "--productos",
+        default="P001,P002,P003",
+        help="product_id consultados, separados por coma",
+    )
+    parser.add_argument(
+        "--tiempo-procesamiento",
+        type=float,
+        default=0.05,
+        help="PROCESSING_TIME de los inventarios (segundos)",
+    )
+    parser.add_argument(
+        "--agrupar",
+        action="store_true",
+        help="agrupar consultas idénticas en curso (COALESCE_REQUESTS=1); "
+        "por defecto se desactiva para medir el fan-out de cada petición",
+    )
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument(
+        "--url",
+        help="validador ya levantado (p. ej. http://localhost:5001) en vez del local",
+    )
+    parser.add_argument(
+        "--directorio",
+        help="directorio de trabajo (inventario.db, metrics.csv); por defecto uno temporal",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="mostrar los logs del validador y los inventarios",
+    )
+    parser.add_argument("--guardar", metavar="JSON", help="guardar el resultado")
+    parser.add_argument(
+        "--comparar",
+        metavar="JSON",
+        help="baseline guardada con --guardar; sale con código 1 si hay regresión",
+    )
+    parser.add_argument(
+        "--tolerancia",
+        type=float,
+        default=0.10,
+        help="empeoramiento relativo admitido antes de marcar regresión",
+    )
+    args = parser.parse_args()
+
+    random.seed(args.semilla)
+    productos = [p.strip() for p in args.productos.split(",") if p.strip()]
+    config = {
+        k: getattr(args, k)
+        for k in (
+            "concurrencia",
+            "tasa",
+            "duracion",
+            "productos",
+            "tiempo_procesamiento",
+            "url",
+        )
+    }
+    if not args.url:
+        # Con pocos productos casi todo se agruparía en un solo fan-out; una
+        # COALESCE_REQUESTS explícita en el entorno tiene prioridad
+        if args.agrupar:
+            os.environ["COALESCE_REQUESTS"] = "1"
+        else:
+            os.environ.setdefault("COALESCE_REQUESTS", "0")
+        config["entorno"] = entorno_relevante()
+
+    # Los print de los servicios van a /dev/null; el reporte a la salida real
+    salida = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+
+    bus = None
+    if args.url:
+        enviar = cliente_http(args.url)
+    else:
+        directorio = args.directorio or tempfile.mkdtemp(prefix="benchmark_")
+        os.makedirs(directorio, exist_ok=True)
+        validador, bus = local_stack.levantar(
+            directorio, args.tiempo_procesamiento, trazar=True
+        )
+        enviar = cliente_local(validador)
+        print(f"Sistema local en {directorio}", file=salida)
+
+    if args.calentamiento > 0:
+        ejecutar_carga(
+            enviar,
+            productos,
+            args.concurrencia,
+            args.calentamiento,
+            args.tasa,
+            args.semilla,
+        )
+    if bus is not None:
+        bus.reiniciar_etapas()
+    inicio = time.perf_counter()
+    resultados = ejecutar_carga(
+        enviar, productos, args.concurrencia, args.duracion, args.tasa, args.semilla
+    )
+    duracion = time.perf_counter() - inicio
+
+    etapas = bus.etapas() if bus is not None else {}
+    resumen = resumir(resultados, duracion, etapas, config)
+    imprimir(resumen, salida)
+
+    if args.guardar:
+        with open(args.guardar, "w") as f:
+            json.dump(resumen, f, indent=2, sort_keys=True)
+        print(f"Guardado: {args.guardar}", file=salida)
+
+    if args.comparar:
+        with open(args.comparar) as f:
+            baseline = json.load(f)
+        if comparar(resumen, baseline, args.tolerancia, salida):
+            sys.exit(1)
@@ -2,9 +2,25 @@ import os
 import json
 import pika
 import time
-from flask import Flask
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response
 import random
+import threading
+import pathlib
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+)
 
+try:
+    import msgpack
+except ImportError:  # Sin msgpack solo se habla JSON
+    msgpack = None
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from models import Base, Product
@@ -23,17 +39,199 @@ app = Flask(__name__)
 # Obtener número de instancia
 instance_number = os.getenv("INSTANCE_NUMBER", "1")
 
-# Leer configuración para override_quantity
-import pathlib
+# Micro-lotes (INVENTARIO_BATCH_SIZE > 1): se juntan hasta BATCH_SIZE
+# mensajes o lo que llegue en BATCH_WAIT_MS desde el primero, y el lote se
+# procesa con una sola búsqueda, una ráfaga de respuestas y un ack múltiple
+BATCH_SIZE = max(1, int(os.getenv("INVENTARIO_BATCH_SIZE", "1")))
+BATCH_WAIT = float(os.getenv("INVENTARIO_BATCH_WAIT_MS", "5")) / 1000.0
+
+# Workers por instancia, mensajes sin ack permitidos y tiempo simulado; el
+# prefetch por defecto alcanza para un lote completo por worker
+WORKERS = int(os.getenv("INVENTARIO_WORKERS", "4"))
+PREFETCH = int(os.getenv("INVENTARIO_PREFETCH", str(WORKERS * BATCH_SIZE)))
+PROCESSING_TIME = float(os.getenv("PROCESSING_TIME", "1"))
+
+# Configuración (inventario_config.json), recargada solo si cambia su mtime
+CONFIG_PATH = pathlib.Path(__file__).parent / "inventario_config.json"
+CONFIG_CHECK_INTERVAL = float(os.getenv("CONFIG_CHECK_INTERVAL", "2"))
+
+# TTL (segundos) de la caché de productos; 0 la desactiva
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "5"))
+
+# Métricas en memoria para /metrics. Registro propio por módulo: así
+# local_stack.py puede cargar las tres instancias en un mismo proceso
+metrics_registry = CollectorRegistry()
+REQUESTS = Counter(
+    "inventario_requests_total",
+    "Solicitudes procesadas por resultado",
+    ["outcome"],
+    registry=metrics_registry,
+)
+PROCESSING_SECONDS = Histogram(
+    "inventario_processing_seconds",
+    "Tiempo de handle_request (incluye el procesamiento simulado)",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0),
+    registry=metrics_registry,
+)
+DB_LOOKUP_SECONDS = Histogram(
+    "inventario_db_lookup_seconds",
+    "Tiempo de búsqueda de productos (caché o BD)",
+    ["kind"],
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5),
+    registry=metrics_registry,
+)
+CONSUME_WAIT_SECONDS = Histogram(
+    "inventario_consume_wait_seconds",
+    "Tiempo desde la entrega del mensaje hasta que un worker lo toma",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0),
+    registry=metrics_registry,
+)
+EXPIRED = Counter(
+    "inventario_expired_total",
+    "Solicitudes descartadas por tener el deadline vencido",
+    ["stage"],
+    registry=metrics_registry,
+)
+BATCH_MESSAGES = Histogram(
+    "inventario_batch_messages",
+    "Mensajes por micro-lote procesado",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+    registry=metrics_registry,
+)
+PUBLISH_SECONDS = Histogram(
+    "inventario_publish_seconds",
+    "Tiempo de publicar la respuesta en el broker",
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1),
+    registry=metrics_registry,
+)
+
+# Codificaciones de mensaje: JSON (sobre {"request_id", "data"}) o msgpack
+# con sobre plano, donde el request_id es el correlation_id. La respuesta
+# usa la misma que la request
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/x-msgpack"
+
+
+class MessageDecodeError(ValueError):
+    """Cuerpo que no se puede decodificar con su content_type"""
+
+
+class RequestExpired(Exception):
+    """El deadline de la request venció durante el procesamiento"""
+
+
+# Deadline absoluto (milisegundos epoch, entero) que el validador pone en
+# cada request: lo que llega vencido se descarta sin procesar, nadie espera
+# la respuesta
+DEADLINE_HEADER = "x-deadline"
+
+# Marcas de tiempo por etapa que viajan como headers AMQP (ver el validador),
+# en microsegundos epoch enteros: las de la request vuelven en la respuesta
+# junto con las de esta instancia
+STAMP_PREFIX = "x-ts-"
+TS_INVENTARIO_DEQUEUE = "x-ts-inventario-dequeue"
+TS_INVENTARIO_START = "x-ts-inventario-start"
+TS_DB_START = "x-ts-db-start"
+TS_DB_END = "x-ts-db-end"
+TS_RESPONSE_PUBLISH = "x-ts-response-publish"
+
+_config = {}
+_config_mtime = None
+_config_checked_at = 0.0
+_config_lock = threading.Lock()
+
+
+def get_config():
+    """Configuración en memoria; el mtime del archivo se revisa como mucho
+    cada CONFIG_CHECK_INTERVAL segundos, así el camino caliente no toca disco"""
+    global _config, _config_mtime, _config_checked_at
+
+    now = time.monotonic()
+    if now - _config_checked_at < CONFIG_CHECK_INTERVAL:
+        return _config
+
+    with _config_lock:
+        if now - _config_checked_at < CONFIG_CHECK_INTERVAL:
+            return _config
+        _config_checked_at = now
+        try:
+            mtime = CONFIG_PATH.stat().st_mtime
+            if mtime != _config_mtime:
+                with open(CONFIG_PATH, "r") as f:
+                    _config = json.load(f)
+                _config_mtime = mtime
+                print(f"[INVENTARIO {instance_number}] [CONFIG] Loaded: {_config}")
+        except Exception as e:
+            print(f"[INVENTARIO {instance_number}] [CONFIG] Error loading config: {e}")
+            _config = {}
+            _config_mtime = None
+    return _config
+
+
+class ProductCache:
+    """Caché de lectura de productos delante de models.Product
+
+    Guarda (quantity, in_stock) por product_id, incluidos los productos que
+    no existen, durante `ttl` segundos. En un acierto no se abre sesión ni
+    se consulta la BD; en un fallo la sesión se cierra siempre.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, product_id):
+        return self.get_many([product_id])[product_id]
+
+    def get_many(self, product_ids):
+        """Resolver varios productos; los fallos van en una sola consulta IN"""
+        now = time.monotonic()
+        result = {}
+        missing = []
+        with self._lock:
+            for product_id in dict.fromkeys(product_ids):
+                entry = self._entries.get(product_id)
+                if entry is not None and entry[0] > now:
+                    self.hits += 1
+                    result[product_id] = entry[1]
+                else:
+                    self.misses += 1
+                    missing.append(product_id)
+
+        if missing:
+            loaded = self._load_many(missing)
+            if self.ttl > 0:
+                expires_at = time.monotonic() + self.ttl
+                with self._lock:
+                    for product_id, value in loaded.items():
+                        self._entries[product_id] = (expires_at, value)
+            result.update(loaded)
+        return result
+
+    def invalidate(self, product_id=None):
+        with self._lock:
+            if product_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(product_id, None)
 
-config_path = pathlib.Path(__file__).parent / "inventario_config.json"
-try:
-    with open(config_path, "r") as f:
-        config = json.load(f)
-    override_quantity = config.get("override_quantity", False)
-except Exception as e:
-    print(f"[INVENTARIO {instance_number}] [CONFIG] Error loading config: {e}")
-    override_quantity = False
+    def _load_many(self, product_ids):
+        with SessionLocal() as db:
+            products = (
+                db.query(Product).filter(Product.product_id.in_(product_ids)).all()
+            )
+            # Producto encontrado en BD
+            found = {p.product_id: (p.quantity, p.in_stock) for p in products}
+        # Si no existe, se retorna con stock=0
+        return {
+            product_id: found.get(product_id, (0, False)) for product_id in product_ids
+        }
+
+
+product_cache = ProductCache(PRODUCT_CACHE_TTL)
 
 
 def get_rabbitmq_connection():
@@ -60,177 +258,693 @@ def get_rabbitmq_connection():
                 raise
 
 
-def process_requests():
-    """Procesar solicitudes de RabbitMQ"""
+def product_data(product_id, quantity, in_stock, config):
+    """Datos de un producto tal como los devuelve esta instancia"""
+    # override_quantity en la config lo fuerza; si no, por probabilidad
+    # (70% false, 30% true)
+    override_quantity = config.get("override_quantity", False) or random.random() < 0.3
 
-    def callback(ch, method, properties, body):
+    try:
+        inst_num = int(instance_number)
+    except Exception:
+        inst_num = instance_number
+    if override_quantity and inst_num == 2:
+        quantity = 500
+    elif override_quantity and inst_num == 3:
+        quantity = 300
+
+    print(
+        f"[INVENTARIO {instance_number}] [OVERRIDE] {product_id}: {override_quantity}"
+    )
+
+    return {
+        "product_id": product_id,
+        "in_stock": in_stock,
+        "quantity": quantity,
+        "instance": instance_number,
+        "timestamp": time.time(),
+    }
+
+
+def handle_request(body, properties, stamps=None):
+    """Procesar una solicitud (en un hilo del pool) y construir la respuesta
+
+    No toca el canal: devuelve (destino, respuesta) para que la
+    publicación y el ack se hagan en el hilo de la conexión. Las marcas de
+    inicio y fin de la búsqueda se agregan a `stamps`.
+    """
+    if stamps is None:
+        stamps = {}
+    print(f"[INVENTARIO {instance_number}] [RECEIVED] Raw message: {body}")
+    print(
+        f"[INVENTARIO {instance_number}] [PROPERTIES] Content-Type: {getattr(properties, 'content_type', None)} Headers: {getattr(properties, 'headers', None)}"
+    )
+    data, content_type = decode_request(body, properties)
+    request_id = data.get("request_id")
+    request_data = data.get("data")
+    reply = reply_target(data, properties, content_type)
+    print(
+        f"[INVENTARIO {instance_number}] [PROCESSING] Request ID: {request_id}, Data: {request_data}, Reply: {reply}"
+    )
+    # Simular procesamiento
+    processing_time = PROCESSING_TIME
+    time.sleep(processing_time)
+    # Pudo vencer mientras tanto: nadie espera la respuesta
+    if request_expired(properties, time.time()):
+        raise RequestExpired(request_id)
+    config = get_config()
+
+    # Lote: todos los productos se resuelven con una sola consulta IN
+    kind = "batch" if "product_ids" in request_data else "single"
+    stamps[TS_DB_START] = stamp(time.time())
+    with DB_LOOKUP_SECONDS.labels(kind).time():
+        products = product_cache.get_many(requested_products(request_data))
+    stamps[TS_DB_END] = stamp(time.time())
+
+    response = build_response(
+        request_id, request_data, products, processing_time, config
+    )
+    print(f"[INVENTARIO {instance_number}] [RESPONSE] Ready to send: {response}")
+    return reply, response
+
+
+def handle_requests(messages, simulate=True):
+    """Procesar un micro-lote de (body, properties, stamps)
+
+    Una sola espera simulada de PROCESSING_TIME por lote (modela un costo
+    fijo por ida y vuelta, no por mensaje) y una sola búsqueda para los
+    productos de todos los mensajes. Devuelve, en el mismo orden, (destino,
+    respuesta), la MessageDecodeError del mensaje que no se pudo decodificar
+    o RequestExpired si venció durante la espera. simulate=False omite la
+    espera (ya se hizo en el intento del lote).
+    """
+    decoded = []
+    for body, properties, stamps in messages:
         try:
-            print(f"[INVENTARIO {instance_number}] [RECEIVED] Raw message: {body}")
-            print(
-                f"[INVENTARIO {instance_number}] [PROPERTIES] Content-Type: {getattr(properties, 'content_type', None)} Headers: {getattr(properties, 'headers', None)}"
-            )
-            data = json.loads(body)
-            request_id = data.get("request_id")
-            request_data = data.get("data")
-            response_routing_key = data.get("response_routing_key")
-            print(
-                f"[INVENTARIO {instance_number}] [PROCESSING] Request ID: {request_id}, Data: {request_data}, Routing Key: {response_routing_key}"
-            )
-            # Simular procesamiento
-            processing_time = 1  # 1 segundo de procesamiento simulado
-            time.sleep(processing_time)
-            # Leer config en cada ciclo para asegurar que cada instancia la lea correctamente
-            import pathlib
+            data, content_type = decode_request(body, properties)
+        except MessageDecodeError as e:
+            decoded.append(e)
+            continue
+        reply = reply_target(data, properties, content_type)
+        decoded.append((data, reply, properties, stamps))
+    requests = [item for item in decoded if not isinstance(item, Exception)]
+    print(
+        f"[INVENTARIO {instance_number}] [BATCH] Processing {len(requests)} requests: {[item[0].get('request_id') for item in requests]}"
+    )
+    processing_time = PROCESSING_TIME
+    if simulate:
+        time.sleep(processing_time)
+    config = get_config()
+
+    # Lo que venció durante la espera no se consulta ni se responde
+    now = time.time()
+    for index, item in enumerate(decoded):
+        if not isinstance(item, Exception) and request_expired(item[2], now):
+            decoded[index] = RequestExpired(item[0].get("request_id"))
+
+    product_ids = []
+    for item in decoded:
+        if not isinstance(item, Exception):
+            product_ids.extend(requested_products(item[0].get("data")))
+    db_start = stamp(time.time())
+    with DB_LOOKUP_SECONDS.labels("micro_batch").time():
+        products = product_cache.get_many(product_ids)
+    db_end = stamp(time.time())
+
+    results = []
+    for item in decoded:
+        if isinstance(item, Exception):
+            results.append(item)
+            continue
+        data, reply, _, stamps = item
+        stamps[TS_DB_START] = db_start
+        stamps[TS_DB_END] = db_end
+        response = build_response(
+            data.get("request_id"),
+            data.get("data"),
+            products,
+            processing_time,
+            config,
+        )
+        print(f"[INVENTARIO {instance_number}] [RESPONSE] Ready to send: {response}")
+        results.append((reply, response))
+    return results
+
 
-            config_path = pathlib.Path(__file__).parent / "inventario_config.json"
+def handle_each(messages):
+    """handle_requests de a un mensaje, sin repetir la espera simulada
+
+    Para cuando el lote completo falló: el error queda solo en el mensaje
+    que lo causó, como excepción en su lugar del resultado.
+    """
+    results = []
+    for message in messages:
+        try:
+            results.extend(handle_requests([message], simulate=False))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def requested_products(request_data):
+    """product_id pedidos por una request simple o de lote"""
+    if "product_ids" in request_data:
+        return list(request_data["product_ids"])
+    return [request_data.get("product_id", "unknown")]
+
+
+def build_response(request_id, request_data, products, processing_time, config):
+    """Respuesta de una request con los productos ya resueltos"""
+    if "product_ids" in request_data:
+        items = []
+        for product_id in request_data["product_ids"]:
+            quantity, in_stock = products[product_id]
+            items.append(product_data(product_id, quantity, in_stock, config))
+        response_payload = {"items": items}
+    else:
+        product_id = request_data.get("product_id", "unknown")
+        quantity, in_stock = products[product_id]
+        response_payload = product_data(product_id, quantity, in_stock, config)
+
+    return {
+        "microservice_id": int(instance_number),
+        "request_id": request_id,
+        "status": "processed",
+        "processing_time": processing_time,
+        "data": response_payload,
+    }
+
+
+def decode_request(body, properties):
+    """(sobre JSON, content_type) de una request en cualquiera de los formatos
+
+    Un cuerpo que decodifica pero no tiene la forma de una request (p. ej.
+    "data": null) también es MessageDecodeError: reencolarlo fallaría igual.
+    """
+    content_type = getattr(properties, "content_type", None)
+    try:
+        if content_type == MSGPACK_CONTENT_TYPE:
+            if msgpack is None:
+                raise MessageDecodeError("msgpack is not installed")
+            data = {
+                "request_id": getattr(properties, "correlation_id", None),
+                "data": msgpack.unpackb(body),
+            }
+            content_type = MSGPACK_CONTENT_TYPE
+        else:
+            data = json.loads(body)
+            content_type = JSON_CONTENT_TYPE
+    except MessageDecodeError:
+        raise
+    except Exception as e:
+        raise MessageDecodeError(str(e)) from e
+    check_request(data)
+    return data, content_type
+
+
+def check_request(data):
+    """Forma mínima de una request: sobre y datos como objetos, product_ids
+    (si está) como lista, y cada product_id texto o entero"""
+    if not isinstance(data, dict):
+        raise MessageDecodeError(f"request is not an object: {type(data).__name__}")
+    request_data = data.get("data")
+    if not isinstance(request_data, dict):
+        raise MessageDecodeError(
+            f"request data is not an object: {type(request_data).__name__}"
+        )
+    if "product_ids" in request_data:
+        product_ids = request_data["product_ids"]
+        if not isinstance(product_ids, list):
+            raise MessageDecodeError("product_ids is not a list")
+    else:
+        product_ids = [request_data.get("product_id", "unknown")]
+    for product_id in product_ids:
+        # Se usan como claves de la caché y en la consulta IN
+        if not isinstance(product_id, (str, int)):
+            raise MessageDecodeError(f"invalid product_id: {product_id!r}")
+
+
+# Dónde y cómo publicar la respuesta
+Reply = namedtuple(
+    "Reply", "exchange routing_key correlation_id content_type delivery_mode"
+)
+
+
+def reply_target(data, properties, content_type=JSON_CONTENT_TYPE):
+    """Reply de la respuesta: misma codificación y persistencia que la request
+
+    Se usa la cola reply_to del validador que hizo la request; el
+    response_routing_key del cuerpo queda solo para mensajes antiguos.
+    """
+    correlation_id = getattr(properties, "correlation_id", None) or data.get(
+        "request_id"
+    )
+    delivery_mode = getattr(properties, "delivery_mode", None) or 2
+    reply_to = getattr(properties, "reply_to", None)
+    if reply_to:
+        return Reply("", reply_to, correlation_id, content_type, delivery_mode)
+    return Reply(
+        "responses",
+        data.get("response_routing_key"),
+        correlation_id,
+        content_type,
+        delivery_mode,
+    )
+
+
+def request_expired(properties, now):
+    """La request trae deadline (DEADLINE_HEADER) y ya pasó"""
+    headers = getattr(properties, "headers", None) or {}
+    deadline = headers.get(DEADLINE_HEADER)
+    return deadline is not None and now * 1000 >= deadline
+
+
+def response_message(response_data, content_type=JSON_CONTENT_TYPE):
+    """Cuerpo de la respuesta con la estructura que espera el validador"""
+    if content_type == MSGPACK_CONTENT_TYPE:
+        # Sobre plano: el request_id ya va como correlation_id
+        return msgpack.packb(
+            {k: v for k, v in response_data.items() if k != "request_id"}
+        )
+    message = {
+        "request_id": response_data["request_id"],
+        "microservice_id": response_data["microservice_id"],
+        "response": response_data,  # Enviar todo el objeto de respuesta
+    }
+    return json.dumps(message)
+
+
+def stamp(t):
+    """Marca x-ts-* para un header: epoch `t` (segundos) en microsegundos"""
+    return int(t * 1_000_000)
+
+
+def request_stamps(properties, dequeued):
+    """Marcas x-ts-* de la request más la de desencolado en esta instancia"""
+    headers = getattr(properties, "headers", None) or {}
+    stamps = {k: v for k, v in headers.items() if k.startswith(STAMP_PREFIX)}
+    stamps[TS_INVENTARIO_DEQUEUE] = stamp(dequeued)
+    return stamps
+
+
+def response_properties(
+    correlation_id, stamps=None, content_type=JSON_CONTENT_TYPE, delivery_mode=2
+):
+    return pika.BasicProperties(
+        delivery_mode=delivery_mode,  # 2: persistente, 1: transitorio
+        content_type=content_type,
+        correlation_id=correlation_id,
+        headers=stamps,
+    )
+
+
+class RabbitMQTransport:
+    """Transporte por defecto: consumo y respuestas por RabbitMQ.
+
+    Un transporte expone:
+      consume(queue_name, routing_key, prefetch, on_message)
+          bucle bloqueante; on_message(delivery, body, properties) se llama
+          por cada mensaje y no debe bloquear
+      complete(delivery, exchange, routing_key, body, properties)
+          publicar la respuesta y confirmar el mensaje (desde cualquier hilo)
+      complete_batch(deliveries, messages)
+          lo mismo para un micro-lote: messages son tuplas
+          (exchange, routing_key, body, properties)
+      reject(delivery, requeue)
+          descartar o reencolar el mensaje (desde cualquier hilo)
+
+    local_stack.py implementa la misma interfaz en proceso, sin broker.
+
+    Se lleva la cuenta de los delivery tags sin confirmar del canal (solo
+    desde su hilo) para que un micro-lote se confirme con un único
+    basic_ack(multiple=True) cuando no hay mensajes anteriores en curso.
+    """
+
+    def __init__(self):
+        self._unacked = {}
+
+    def consume(self, queue_name, routing_key, prefetch, on_message):
+        def callback(ch, method, properties, body):
+            self._unacked.setdefault(ch, set()).add(method.delivery_tag)
+            on_message((ch, method.delivery_tag), body, properties)
+
+        # Reconexión en caso de fallo
+        while True:
+            connection = None
             try:
-                with open(config_path, "r") as f:
-                    config = json.load(f)
-                override_quantity = config.get("override_quantity", False)
-            except Exception as e:
-                print(
-                    f"[INVENTARIO {instance_number}] [CONFIG] Error loading config: {e}"
+                connection = get_rabbitmq_connection()
+                channel = connection.channel()
+                # Los tags del canal anterior ya no se pueden confirmar
+                self._unacked = {channel: set()}
+
+                # Declarar exchanges de solicitudes y respuestas una sola vez
+                channel.exchange_declare(
+                    exchange="requests", exchange_type="direct", durable=True
+                )
+                channel.exchange_declare(
+                    exchange="responses", exchange_type="direct", durable=True
                 )
-                override_quantity = False
-
-            # quantity = 100
-            # Abrir sesión de DB
-            db = SessionLocal()
 
-            product_id = request_data.get("product_id", "unknown")
-            product = db.query(Product).filter_by(product_id=product_id).first()
+                # Declarar cola para este microservicio
+                channel.queue_declare(queue=queue_name, durable=True)
+                channel.queue_bind(
+                    exchange="requests", queue=queue_name, routing_key=routing_key
+                )
 
-            if product:
-                # Producto encontrado en BD
-                quantity = product.quantity
-                in_stock = product.in_stock
-            else:
-                # Si no existe, puedes decidir retornarlo con stock=0
-                quantity = 0
-                in_stock = False
+                channel.basic_qos(prefetch_count=prefetch)
+                channel.basic_consume(queue=queue_name, on_message_callback=callback)
 
-                db.close()
+                print(
+                    f"Microservice {instance_number} waiting for requests ({WORKERS} workers, prefetch {prefetch})..."
+                )
+                channel.start_consuming()
+            except pika.exceptions.ConnectionClosedByBroker as e:
+                # Reinicio del broker: reconectar sin esperar de más
+                print(f"RabbitMQ closed the connection: {e}. Reconnecting...")
+                time.sleep(1)
+            except Exception as e:
+                print(f"RabbitMQ connection failed: {e}. Retrying in 5 seconds...")
+                time.sleep(5)
+            finally:
+                if connection is not None and connection.is_open:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+
+    def complete(self, delivery, exchange, routing_key, body, properties):
+        channel, delivery_tag = delivery
+
+        def done():
+            # Los errores se propagan para que el bucle de reconexión recupere
+            # el canal; el mensaje queda sin ack y el broker lo reentrega
+            with PUBLISH_SECONDS.time():
+                channel.basic_publish(
+                    exchange=exchange,
+                    routing_key=routing_key,
+                    body=body,
+                    properties=properties,
+                )
+            self._settled(channel, [delivery_tag])
+            channel.basic_ack(delivery_tag=delivery_tag)
+
+        self._in_channel_thread(channel, done)
+
+    def complete_batch(self, deliveries, messages):
+        by_channel = {}
+        for channel, delivery_tag in deliveries:
+            by_channel.setdefault(channel, []).append(delivery_tag)
+
+        def done():
+            # Todas las respuestas en una ráfaga y después los acks
+            with PUBLISH_SECONDS.time():
+                for exchange, routing_key, body, properties in messages:
+                    channel.basic_publish(
+                        exchange=exchange,
+                        routing_key=routing_key,
+                        body=body,
+                        properties=properties,
+                    )
+            for ack_channel, tags in by_channel.items():
+                self._ack_many(ack_channel, sorted(tags))
+
+        channel = deliveries[0][0]
+        self._in_channel_thread(channel, done)
+
+    def reject(self, delivery, requeue):
+        channel, delivery_tag = delivery
+
+        def done():
+            self._settled(channel, [delivery_tag])
+            channel.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
+
+        self._in_channel_thread(channel, done)
+
+    def _settled(self, channel, delivery_tags):
+        self._unacked.get(channel, set()).difference_update(delivery_tags)
+
+    def _ack_many(self, channel, delivery_tags):
+        # Un ack múltiple confirma todo lo pendiente hasta el último tag:
+        # solo se usa si no queda ningún mensaje anterior sin terminar
+        self._settled(channel, delivery_tags)
+        unacked = self._unacked.get(channel, set())
+        last = delivery_tags[-1]
+        if not unacked or min(unacked) > last:
+            channel.basic_ack(delivery_tag=last, multiple=True)
+            return
+        for delivery_tag in delivery_tags:
+            channel.basic_ack(delivery_tag=delivery_tag)
+
+    def _in_channel_thread(self, channel, callback):
+        # pika no es thread-safe: el ack/nack debe ir en el hilo del canal
+        try:
+            channel.connection.add_callback_threadsafe(callback)
+        except Exception as e:
+            # La conexión ya no existe: el broker reentrega el mensaje
+            print(
+                f"[INVENTARIO {instance_number}] [ERROR] Could not hand result back to channel: {e}"
+            )
 
-            # Determinar override_quantity por probabilidad (70% false, 30% true)
-            override_quantity = random.random() < 0.3     
 
-            try:
-                inst_num = int(instance_number)
-            except Exception:
-                inst_num = instance_number
-            if override_quantity and inst_num == 2:
-                quantity = 500
-            elif override_quantity and inst_num == 3:
-                quantity = 300
+transport = RabbitMQTransport()
+
+
+class MicroBatcher:
+    """Junta mensajes hasta `max_size` o hasta `max_wait` segundos desde el
+    primero del lote, y entrega cada lote a `flush(items)` desde su hilo.
+
+    Con poca carga un mensaje espera como mucho `max_wait`; con mucha, los
+    lotes se llenan antes. Con `slots` (un semáforo por worker) no se arma
+    un lote hasta que hay un worker libre: mientras tanto los mensajes se
+    siguen juntando y el lote sale más grande.
+    """
+
+    def __init__(self, max_size, max_wait, flush, slots=None):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.flush = flush
+        self.slots = slots
+        self._items = []
+        self._first_at = None
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def add(self, item):
+        with self._cond:
+            self._items.append(item)
+            if len(self._items) == 1:
+                self._first_at = time.monotonic()
+                self._cond.notify()
+            elif len(self._items) == self.max_size:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            if self.slots is not None:
+                self.slots.acquire()
+            with self._cond:
+                while True:
+                    if not self._items:
+                        self._cond.wait()
+                        continue
+                    if len(self._items) >= self.max_size:
+                        break
+                    remaining = self._first_at + self.max_wait - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._items[: self.max_size]
+                del self._items[: self.max_size]
+                # Lo que sobró empieza a contar desde ahora
+                self._first_at = time.monotonic() if self._items else None
+            self.flush(batch)
 
-            print(
-                f"[INVENTARIO {instance_number}] [OVERRIDE] {override_quantity}"
-            )
 
-            response = {
-                "microservice_id": int(instance_number),
-                "request_id": request_id,
-                "status": "processed",
-                "processing_time": processing_time,
-                "data": {
-                    "product_id": product_id,
-                    "in_stock": in_stock,
-                    "quantity": quantity,
-                    "instance": instance_number,
-                    "timestamp": time.time(),
-                },
-            }
-            print(
-                f"[INVENTARIO {instance_number}] [RESPONSE] Ready to send: {response}"
-            )
-            # Enviar respuesta
-            send_response(response_routing_key, response)
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-            print(
-                f"[INVENTARIO {instance_number}] [COMPLETE] Request {request_id} processed and acknowledged."
-            )
-        except json.JSONDecodeError as e:
+def process_requests():
+    """Procesar solicitudes del transporte con un pool de workers; con
+    BATCH_SIZE > 1 cada worker procesa micro-lotes"""
+    executor = ThreadPoolExecutor(
+        max_workers=WORKERS, thread_name_prefix=f"inventario{instance_number}"
+    )
+
+    def drop_expired(delivery, properties, stage):
+        EXPIRED.labels(stage).inc()
+        REQUESTS.labels("expired").inc()
+        print(
+            f"[INVENTARIO {instance_number}] [EXPIRED] Dropping request {getattr(properties, 'correlation_id', None)} at {stage}"
+        )
+        transport.reject(delivery, requeue=False)
+
+    def work(delivery, properties, body, received, stamps):
+        CONSUME_WAIT_SECONDS.observe(time.perf_counter() - received)
+        started = time.time()
+        stamps[TS_INVENTARIO_START] = stamp(started)
+        # Pudo vencer mientras esperaba un worker libre
+        if request_expired(properties, started):
+            drop_expired(delivery, properties, "worker")
+            return
+        try:
+            with PROCESSING_SECONDS.time():
+                reply, response = handle_request(body, properties, stamps)
+        except MessageDecodeError as e:
             print(
-                f"[INVENTARIO {instance_number}] [ERROR] JSON decode error: {e} | Body: {body}"
+                f"[INVENTARIO {instance_number}] [ERROR] Decode error: {e} | Body: {body}"
             )
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            REQUESTS.labels("decode_error").inc()
+            transport.reject(delivery, requeue=False)
+            return
+        except RequestExpired:
+            drop_expired(delivery, properties, "processing")
+            return
         except Exception as e:
             print(
                 f"[INVENTARIO {instance_number}] [ERROR] Exception processing request: {e}"
             )
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            REQUESTS.labels("error").inc()
+            transport.reject(delivery, requeue=True)
+            return
+        REQUESTS.labels("processed").inc()
+        send_response(delivery, reply, response, stamps)
 
-    # Reconexión en caso de fallo
-    while True:
+    def work_batch(items):
         try:
-            connection = get_rabbitmq_connection()
-            channel = connection.channel()
-
-            # Declarar exchange para solicitudes
-            channel.exchange_declare(
-                exchange="requests", exchange_type="direct", durable=True
-            )
-
-            # Declarar cola para este microservicio
-            queue_name = f"microservice_{instance_number}_queue"
-            channel.queue_declare(queue=queue_name, durable=True)
-            channel.queue_bind(
-                exchange="requests",
-                queue=queue_name,
-                routing_key=f"microservice_{instance_number}",
-            )
-
-            channel.basic_qos(prefetch_count=1)
-            channel.basic_consume(queue=queue_name, on_message_callback=callback)
-
-            print(f"Microservice {instance_number} waiting for requests...")
-            channel.start_consuming()
-        except Exception as e:
-            print(f"RabbitMQ connection failed: {e}. Retrying in 5 seconds...")
-            time.sleep(5)
-
-
-def send_response(routing_key, response_data):
-    """Enviar respuesta a través de RabbitMQ"""
-    try:
-        print(
-            f"[INVENTARIO {instance_number}] [SEND_RESPONSE] Connecting to RabbitMQ to send response..."
-        )
-        connection = get_rabbitmq_connection()
-        channel = connection.channel()
-        # Declarar exchange para respuestas (asegurarse de que existe)
-        channel.exchange_declare(
-            exchange="responses", exchange_type="direct", durable=True
-        )
-        # Crear el mensaje con la estructura correcta que espera el validador
-        message = {
-            "request_id": response_data["request_id"],
-            "microservice_id": response_data["microservice_id"],
-            "response": response_data,  # Enviar todo el objeto de respuesta
-        }
-        print(
-            f"[INVENTARIO {instance_number}] [SEND_RESPONSE] Publishing to exchange 'responses' with routing_key '{routing_key}': {message}"
-        )
-        channel.basic_publish(
-            exchange="responses",
-            routing_key=routing_key,
-            body=json.dumps(message),
-            properties=pika.BasicProperties(
-                delivery_mode=2, content_type="application/json"  # Mensaje persistente
-            ),
+            process_batch(items)
+        finally:
+            slots.release()
+
+    def process_batch(items):
+        started = time.time()
+        batch = []
+        for delivery, properties, body, received, stamps in items:
+            CONSUME_WAIT_SECONDS.observe(time.perf_counter() - received)
+            stamps[TS_INVENTARIO_START] = stamp(started)
+            if request_expired(properties, started):
+                drop_expired(delivery, properties, "worker")
+            else:
+                batch.append((delivery, properties, body, stamps))
+        if not batch:
+            return
+        BATCH_MESSAGES.observe(len(batch))
+        messages = [(body, properties, stamps) for _, properties, body, stamps in batch]
+        with PROCESSING_SECONDS.time():
+            try:
+                results = handle_requests(messages)
+            except Exception as e:
+                # Un mensaje no debe tumbar el lote: se reintenta cada uno
+                print(
+                    f"[INVENTARIO {instance_number}] [ERROR] Exception processing batch, retrying one by one: {e}"
+                )
+                results = handle_each(messages)
+        done = []
+        for (delivery, properties, body, stamps), result in zip(batch, results):
+            if isinstance(result, MessageDecodeError):
+                print(
+                    f"[INVENTARIO {instance_number}] [ERROR] Decode error: {result} | Body: {body}"
+                )
+                REQUESTS.labels("decode_error").inc()
+                transport.reject(delivery, requeue=False)
+                continue
+            if isinstance(result, RequestExpired):
+                drop_expired(delivery, properties, "processing")
+                continue
+            if isinstance(result, Exception):
+                print(
+                    f"[INVENTARIO {instance_number}] [ERROR] Exception processing request: {result}"
+                )
+                REQUESTS.labels("error").inc()
+                transport.reject(delivery, requeue=True)
+                continue
+            reply, response = result
+            done.append((delivery, reply, response, stamps))
+        if done:
+            REQUESTS.labels("processed").inc(len(done))
+            send_responses(done)
+
+    batcher = None
+    slots = threading.Semaphore(WORKERS)
+    if BATCH_SIZE > 1:
+        batcher = MicroBatcher(
+            BATCH_SIZE,
+            BATCH_WAIT,
+            lambda items: executor.submit(work_batch, items),
+            slots,
         )
-        print(
-            f"[INVENTARIO {instance_number}] [SEND_RESPONSE] Response sent and connection closed."
+        batcher.start()
+
+    def on_message(delivery, body, properties):
+        now = time.time()
+        if request_expired(properties, now):
+            drop_expired(delivery, properties, "dequeue")
+            return
+        stamps = request_stamps(properties, now)
+        if batcher is not None:
+            batcher.add((delivery, properties, body, time.perf_counter(), stamps))
+            return
+        executor.submit(work, delivery, properties, body, time.perf_counter(), stamps)
+
+    transport.consume(
+        f"microservice_{instance_number}_queue",
+        f"microservice_{instance_number}",
+        PREFETCH,
+        on_message,
+    )
+
+
+def send_response(delivery, reply, response_data, stamps=None):
+    """Publicar la respuesta y confirmar la solicitud por el transporte"""
+    exchange, routing_key, correlation_id, content_type, delivery_mode = reply
+    print(
+        f"[INVENTARIO {instance_number}] [SEND_RESPONSE] Publishing to exchange '{exchange}' with routing_key '{routing_key}': {response_data}"
+    )
+    if stamps is not None:
+        stamps[TS_RESPONSE_PUBLISH] = stamp(time.time())
+    transport.complete(
+        delivery,
+        exchange,
+        routing_key,
+        response_message(response_data, content_type),
+        response_properties(correlation_id, stamps, content_type, delivery_mode),
+    )
+    print(
+        f"[INVENTARIO {instance_number}] [COMPLETE] Request {response_data['request_id']} processed."
+    )
+
+
+def send_responses(done):
+    """Publicar las respuestas de un micro-lote de (delivery, reply,
+    respuesta, stamps) en una ráfaga y confirmar sus mensajes juntos"""
+    deliveries = []
+    messages = []
+    for delivery, reply, response_data, stamps in done:
+        exchange, routing_key, correlation_id, content_type, delivery_mode = reply
+        stamps[TS_RESPONSE_PUBLISH] = stamp(time.time())
+        deliveries.append(delivery)
+        messages.append(
+            (
+                exchange,
+                routing_key,
+                response_message(response_data, content_type),
+                response_properties(
+                    correlation_id, stamps, content_type, delivery_mode
+                ),
+            )
         )
-        connection.close()
-    except Exception as e:
-        print(f"[INVENTARIO {instance_number}] [ERROR] Error sending response: {e}")
+    print(
+        f"[INVENTARIO {instance_number}] [SEND_RESPONSE] Publishing {len(messages)} responses"
+    )
+    transport.complete_batch(deliveries, messages)
+    print(
+        f"[INVENTARIO {instance_number}] [COMPLETE] Requests {[r['request_id'] for _, _, r, _ in done]} processed."
+    )
 
 
 if __name__ == "__main__":
     # Iniciar consumidor de RabbitMQ en un hilo separado
-    import threading
-
     rabbitmq_thread = threading.Thread(target=process_requests, daemon=True)
     rabbitmq_thread.start()
 
@@ -244,5 +958,11 @@ if __name__ == "__main__":
             "timestamp": time.time(),
         }
 
+    @app.route("/metrics")
+    def metrics():
+        return Response(
+            generate_latest(metrics_registry), content_type=CONTENT_TYPE_LATEST
+        )
+
     port = 5000 + int(instance_number)
     app.run(host="0.0.0.0", port=port, debug=False)
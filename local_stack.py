@@ -0,0 +1,320 @@
+"""Validador y los tres inventarios en un solo proceso, sin RabbitMQ.
+
+Para despliegues en un solo equipo (sitios edge) y pruebas sin broker: los
+servicios son los mismos app.py, pero su `transport` se reemplaza por uno
+en proceso sobre un LocalBus (colas en memoria con prefetch y ack). No hay
+persistencia ni saltos de red: un mensaje pasa de un hilo a otro.
+
+    python local_stack.py --puerto 5000
+
+Los endpoints del validador quedan en http://localhost:5000 igual que en
+docker-compose. El inventario usa ./inventario.db del directorio de trabajo
+(se inicializa con init_db.py).
+"""
+
+import argparse
+import collections
+import importlib.util
+import os
+import queue
+import runpy
+import sys
+import threading
+import time
+
+import pika
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+# Los servicios importan sus módulos por nombre, como en sus contenedores
+sys.path.insert(0, os.path.join(RAIZ, "inventario"))
+sys.path.insert(0, os.path.join(RAIZ, "validador"))
+
+from publisher_confirms import RETURNED
+
+
+class _Entrega:
+    __slots__ = ("consumidor", "mensaje", "entregado")
+
+    def __init__(self, consumidor, mensaje, entregado):
+        self.consumidor = consumidor
+        self.mensaje = mensaje
+        self.entregado = entregado
+
+
+class _Consumidor:
+    def __init__(self, cola, prefetch, on_message):
+        self.cola = cola
+        self.prefetch = prefetch
+        self.on_message = on_message
+        self.sin_ack = 0
+        self.eventos = queue.Queue()
+
+    def tiene_lugar(self):
+        return self.prefetch == 0 or self.sin_ack < self.prefetch
+
+
+def _vencido(mensaje, ahora):
+    """TTL por mensaje (properties.expiration, ms) como en RabbitMQ"""
+    _, properties, publicado = mensaje
+    expiration = getattr(properties, "expiration", None)
+    return expiration is not None and ahora - publicado > int(expiration) / 1000.0
+
+
+def _serializar(properties):
+    """Propiedades tal como las entregaría RabbitMQ: se codifican como en
+    basic_publish (y fallan igual, p. ej. con floats en los headers) y el
+    consumidor recibe una copia decodificada"""
+    if properties is None:
+        return None
+    copia = pika.BasicProperties()
+    copia.decode(b"".join(properties.encode()))
+    return copia
+
+
+class _Cola:
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self.mensajes = collections.deque()
+        self.consumidores = []
+        self.expirados = 0
+        self._siguiente = 0
+
+    def despachar(self):
+        """Entregar a consumidores con lugar, en ronda (con el lock del bus).
+
+        Los mensajes vencidos se descartan al llegar a la cabeza de la cola.
+        """
+        ahora = time.perf_counter()
+        while self.mensajes and self.consumidores:
+            libres = [c for c in self.consumidores if c.tiene_lugar()]
+            if not libres:
+                return
+            mensaje = self.mensajes.popleft()
+            if _vencido(mensaje, ahora):
+                self.expirados += 1
+                continue
+            consumidor = libres[self._siguiente % len(libres)]
+            self._siguiente += 1
+            consumidor.sin_ack += 1
+            consumidor.eventos.put(mensaje)
+
+
+class LocalBus:
+    """Broker en memoria con la semántica que usan los servicios.
+
+    Exchange default ("") hacia la cola con ese nombre y exchanges direct
+    por binding; prefetch por consumidor; ack/nack con reencolado; TTL por
+    mensaje (expiration). Las propiedades se codifican y decodifican con
+    pika al publicar, como en el broker. Con trazar=True guarda cuánto
+    espera cada mensaje en cola y cuánto tarda el inventario en responder,
+    para benchmark.py.
+    """
+
+    def __init__(self, trazar=False):
+        self.trazar = trazar
+        self._lock = threading.Lock()
+        self._cambio = threading.Condition(self._lock)
+        self._colas = {}
+        self._bindings = {}
+        self._etapas = collections.defaultdict(list)
+        self.sin_ruta = 0
+
+    def _cola(self, nombre):
+        cola = self._colas.get(nombre)
+        if cola is None:
+            cola = self._colas[nombre] = _Cola(nombre)
+        return cola
+
+    def bind(self, exchange, routing_key, queue_name):
+        with self._lock:
+            self._cola(queue_name)
+            self._bindings[(exchange, routing_key)] = queue_name
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        """Devuelve False si ninguna cola recibe el mensaje"""
+        properties = _serializar(properties)
+        with self._lock:
+            if exchange == "":
+                nombre = routing_key
+            else:
+                nombre = self._bindings.get((exchange, routing_key))
+            cola = self._colas.get(nombre)
+            if cola is None:
+                self.sin_ruta += 1
+                return False
+            cola.mensajes.append((body, properties, time.perf_counter()))
+            cola.despachar()
+            return True
+
+    def consume(self, queue_name, prefetch, on_message):
+        """Bucle bloqueante: on_message(entrega, body, properties) por mensaje"""
+        with self._lock:
+            cola = self._cola(queue_name)
+            consumidor = _Consumidor(cola, prefetch, on_message)
+            cola.consumidores.append(consumidor)
+            self._cambio.notify_all()
+            cola.despachar()
+        solicitud = queue_name.startswith("microservice_")
+        while True:
+            mensaje = consumidor.eventos.get()
+            body, properties, publicado = mensaje
+            entrega = _Entrega(consumidor, mensaje, time.perf_counter())
+            if self.trazar:
+                etapa = "cola_solicitud" if solicitud else "cola_respuesta"
+                self.registrar_etapa(etapa, entrega.entregado - publicado)
+            on_message(entrega, body, properties)
+
+    def ack(self, entrega):
+        with self._lock:
+            entrega.consumidor.sin_ack -= 1
+            entrega.consumidor.cola.despachar()
+
+    def nack(self, entrega, requeue):
+        with self._lock:
+            consumidor = entrega.consumidor
+            consumidor.sin_ack -= 1
+            if requeue:
+                consumidor.cola.mensajes.appendleft(entrega.mensaje)
+            consumidor.cola.despachar()
+
+    def expirados(self):
+        with self._lock:
+            return sum(cola.expirados for cola in self._colas.values())
+
+    def esperar_consumidor(self, queue_name, timeout=10):
+        with self._lock:
+            if not self._cambio.wait_for(
+                lambda: queue_name in self._colas
+                and self._colas[queue_name].consumidores,
+                timeout,
+            ):
+                raise RuntimeError(f"nadie consume la cola {queue_name}")
+
+    def registrar_etapa(self, etapa, duracion):
+        with self._lock:
+            self._etapas[etapa].append(duracion)
+
+    def etapas(self):
+        with self._lock:
+            return {k: list(v) for k, v in self._etapas.items()}
+
+    def reiniciar_etapas(self):
+        with self._lock:
+            self._etapas.clear()
+
+
+class ValidadorLocalTransport:
+    """Interfaz de transporte del validador (ver RabbitMQTransport) sobre un LocalBus"""
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def start(self):
+        pass
+
+    def publish(self, routing_key, body, properties, confirm=None):
+        enrutado = self.bus.publish("requests", routing_key, body, properties)
+        # Sin broker el "confirm" es inmediato; sin cola, como un basic.return
+        if confirm is not None:
+            if enrutado:
+                confirm.ack()
+            else:
+                confirm.fail(RETURNED)
+
+    def consume(self, queue_name, on_message):
+        def entregar(entrega, body, properties):
+            # on_message devuelve ACK ("ack"), REJECT o REQUEUE ("requeue")
+            outcome = on_message(body, properties)
+            if outcome == "ack":
+                self.bus.ack(entrega)
+            else:
+                self.bus.nack(entrega, requeue=outcome == "requeue")
+
+        self.bus.consume(queue_name, 0, entregar)
+
+
+class InventarioLocalTransport:
+    """Interfaz de transporte del inventario (ver RabbitMQTransport) sobre un LocalBus"""
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def consume(self, queue_name, routing_key, prefetch, on_message):
+        self.bus.bind("requests", routing_key, queue_name)
+        self.bus.consume(queue_name, prefetch, on_message)
+
+    def complete(self, delivery, exchange, routing_key, body, properties):
+        if self.bus.trazar:
+            self.bus.registrar_etapa(
+                "inventario", time.perf_counter() - delivery.entregado
+            )
+        self.bus.publish(exchange, routing_key, body, properties)
+        self.bus.ack(delivery)
+
+    def complete_batch(self, deliveries, messages):
+        if self.bus.trazar:
+            ahora = time.perf_counter()
+            for delivery in deliveries:
+                self.bus.registrar_etapa("inventario", ahora - delivery.entregado)
+        for exchange, routing_key, body, properties in messages:
+            self.bus.publish(exchange, routing_key, body, properties)
+        for delivery in deliveries:
+            self.bus.ack(delivery)
+
+    def reject(self, delivery, requeue):
+        self.bus.nack(delivery, requeue)
+
+
+def _cargar(nombre, ruta):
+    spec = importlib.util.spec_from_file_location(nombre, ruta)
+    modulo = importlib.util.module_from_spec(spec)
+    sys.modules[nombre] = modulo
+    spec.loader.exec_module(modulo)
+    return modulo
+
+
+def levantar(directorio=None, tiempo_procesamiento=None, trazar=False):
+    """Cargar y conectar los servicios; devuelve (validador, bus).
+
+    Las variables de entorno de cada servicio (WORKERS, QUORUM_*, etc.)
+    se leen al cargar los módulos, así que deben fijarse antes.
+    """
+    if directorio is not None:
+        os.makedirs(directorio, exist_ok=True)
+        os.chdir(directorio)
+    if tiempo_procesamiento is not None:
+        os.environ["PROCESSING_TIME"] = str(tiempo_procesamiento)
+
+    # init_db.py crea ./inventario.db en el directorio de trabajo
+    runpy.run_path(os.path.join(RAIZ, "inventario", "init_db.py"))
+
+    bus = LocalBus(trazar=trazar)
+    for numero in (1, 2, 3):
+        os.environ["INSTANCE_NUMBER"] = str(numero)
+        inventario = _cargar(
+            f"inventario_{numero}", os.path.join(RAIZ, "inventario", "app.py")
+        )
+        inventario.transport = InventarioLocalTransport(bus)
+        threading.Thread(target=inventario.process_requests, daemon=True).start()
+
+    validador = _cargar("validador_app", os.path.join(RAIZ, "validador", "app.py"))
+    validador.transport = ValidadorLocalTransport(bus)
+    validador.transport.start()
+    threading.Thread(target=validador.setup_rabbitmq_consumer, daemon=True).start()
+
+    bus.esperar_consumidor(validador.get_reply_queue())
+    for numero in (1, 2, 3):
+        bus.esperar_consumidor(f"microservice_{numero}_queue")
+    return validador, bus
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sistema completo en un proceso")
+    parser.add_argument("--puerto", type=int, default=5000)
+    parser.add_argument(
+        "--directorio", help="directorio de trabajo (inventario.db, metrics.csv)"
+    )
+    args = parser.parse_args()
+
+    validador, _ = levantar(args.directorio)
+    validador.app.run(host="0.0.0.0", port=args.puerto, debug=False)
@@ -1,91 +1,51 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 import pika
-import json
 import threading
-import os
 import time
 import sys
-import csv
-from collections import Counter
+import queue
+import os
+import signal
+
+from coalescing import single_flight_from_env
+import live_metrics
+from pending_store import StoreFull
+from publisher_confirms import UNPUBLISHABLE, ConfirmTracker
+from consensus import (
+    ACK,
+    DEADLINE_HEADER,
+    PUBLISHER_CONFIRMS,
+    REQUEUE,
+    InvalidRequest,
+    PendingRequest,
+    batch_steps,
+    check_batch_request,
+    check_request,
+    coalescing_key,
+    consensus_steps,
+    get_reply_queue,
+    handle_response,
+    health_status,
+    log_coalesced,
+    log_metric,
+    run_steps,
+)
 
 sys.stdout.reconfigure(line_buffering=True)
 
 app = Flask(__name__)
 
-responses = {}
-responses_lock = threading.Lock()
-current_request_id = 0
-
-# Para medir latencias por request
-request_start_times = {}
-
-METRICS_FILE = "metrics.csv"
-
-# Lock para escritura en CSV (evita colisiones entre hilos)
-metrics_lock = threading.Lock()
-
-# Inicializar CSV con encabezados si no existe
-if not os.path.exists(METRICS_FILE):
-    with open(METRICS_FILE, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(
-            [
-                "timestamp",
-                "event",
-                "request_id",
-                "status",
-                "extra_info",
-                "microservice_id",
-                "failed_microservices",
-                "proc_id",
-                "thread_id",
-            ]
-        )
+RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
 
+# Consultas idénticas en curso comparten un solo fan-out; con
+# QUERY_CACHE_TTL_MS > 0 los consensos se reutilizan durante ese TTL
+single_flight = single_flight_from_env(cacheable=lambda result: result[1] == 200)
 
-def log_metric(
-    event,
-    request_id=None,
-    status="",
-    extra_info="",
-    microservice_id="-",
-    failed_microservices=None,
-):
-    proc_id = os.getpid()
-    thread_id = threading.get_ident()
 
-    # Asegurarse que extra_info sea string
-    if not isinstance(extra_info, str):
-        try:
-            extra_info = json.dumps(extra_info, ensure_ascii=False)
-        except Exception:
-            extra_info = str(extra_info)
-
-    # Serializar lista de microservicios fallidos
-    failed_str = "-"
-    if failed_microservices is not None:
-        try:
-            failed_str = json.dumps(failed_microservices, ensure_ascii=False)
-        except Exception:
-            failed_str = str(failed_microservices)
-
-    # Escritura thread-safe
-    with metrics_lock:
-        with open(METRICS_FILE, "a", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(
-                [
-                    time.time(),
-                    event,
-                    request_id or "-",
-                    status,
-                    extra_info,
-                    microservice_id,
-                    failed_str,
-                    proc_id,
-                    thread_id,
-                ]
-            )
+def get_rabbitmq_parameters():
+    return pika.ConnectionParameters(
+        host=RABBITMQ_HOST, connection_attempts=5, retry_delay=3
+    )
 
 
 def get_rabbitmq_connection():
@@ -93,11 +53,7 @@ def get_rabbitmq_connection():
     retry_delay = 3
     for attempt in range(max_retries):
         try:
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters(
-                    host="rabbitmq", connection_attempts=5, retry_delay=3
-                )
-            )
+            connection = pika.BlockingConnection(get_rabbitmq_parameters())
             log_metric(
                 "rabbitmq_connect",
                 status="success",
@@ -119,245 +75,361 @@ def get_rabbitmq_connection():
                 raise
 
 
-def setup_rabbitmq_consumer():
-    def callback(ch, method, properties, body):
+def publish_request(
+    channel, tracker, confirms, exchange, routing_key, body, properties, confirm
+):
+    """basic_publish de una request con su Confirm, desde el hilo de su
+    conexión. Devuelve False si falló la conexión o el canal: hay que
+    reintentarla al reconectar. Cualquier otro error (p. ej. un header que
+    no se puede codificar) fallaría igual al reintentar, así que la request
+    se descarta y su confirm falla como UNPUBLISHABLE"""
+    try:
+        with live_metrics.PUBLISH_TIME.time():
+            channel.basic_publish(
+                exchange=exchange,
+                routing_key=routing_key,
+                body=body,
+                properties=properties,
+                mandatory=confirms,
+            )
+    except (
+        pika.exceptions.AMQPConnectionError,
+        pika.exceptions.AMQPChannelError,
+    ) as e:
+        log_metric(
+            "publisher_error",
+            status="publish_failed",
+            extra_info=str(e),
+            microservice_id="-",
+            failed_microservices=[],
+        )
+        return False
+    except Exception as e:
+        log_metric(
+            "publisher_error",
+            status="publish_dropped",
+            extra_info=f"{routing_key}: {e}",
+            microservice_id="-",
+            failed_microservices=[],
+        )
+        if confirm is not None:
+            confirm.fail(UNPUBLISHABLE)
+        return True
+    if confirms:
+        tracker.published(routing_key, properties, confirm)
+    return True
+
+
+class RabbitPublisher:
+    """Publicador persistente compartido por todos los hilos HTTP.
+
+    Un hilo dedicado mantiene abierta una SelectConnection con un único canal.
+    Los hilos HTTP solo encolan la publicación y despiertan al ioloop con
+    add_callback_threadsafe, de modo que nunca tocan la conexión directamente.
+    Los exchanges se declaran una vez por conexión y, si la conexión se cae,
+    los mensajes esperan en la cola hasta que se reconecta.
+
+    Con confirms=True el canal pasa a modo confirm y se publica con
+    mandatory: cada mensaje puede llevar un Confirm (ver publisher_confirms)
+    que se resuelve cuando llega su ack, nack o return.
+    """
+
+    def __init__(self, exchanges, reconnect_delay=3, confirms=False):
+        self._exchanges = exchanges
+        self._reconnect_delay = reconnect_delay
+        self._confirms = confirms
+        self._tracker = ConfirmTracker()
+        self._outbox = queue.Queue()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._channel = None
+        self._ready = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def publish(self, exchange, routing_key, body, properties, confirm=None):
+        """Encolar un mensaje; es seguro llamarlo desde cualquier hilo."""
+        self._outbox.put((exchange, routing_key, body, properties, confirm))
+        self._wakeup()
+
+    def _wakeup(self):
+        with self._lock:
+            connection = self._connection
+        if connection is None:
+            return
         try:
-            data = json.loads(body)
-            request_id = str(data["request_id"])
-            microservice_id = data["microservice_id"]
-            response_data = data["response"]
-
-            with responses_lock:
-                if request_id not in responses:
-                    responses[request_id] = []
-                responses[request_id].append(
-                    {"microservice_id": microservice_id, "response": response_data}
+            connection.ioloop.add_callback_threadsafe(self._drain)
+        except Exception:
+            # La conexión se está cerrando: el mensaje se envía al reconectar
+            pass
+
+    def _run(self):
+        while True:
+            connection = pika.SelectConnection(
+                get_rabbitmq_parameters(),
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_open_error,
+                on_close_callback=self._on_connection_closed,
+            )
+            with self._lock:
+                self._connection = connection
+            try:
+                connection.ioloop.start()
+            except Exception as e:
+                log_metric(
+                    "publisher_error",
+                    status="ioloop_failed",
+                    extra_info=str(e),
+                    microservice_id="-",
+                    failed_microservices=[],
                 )
+            with self._lock:
+                self._connection = None
+                self._channel = None
+                self._ready = False
+            time.sleep(self._reconnect_delay)
 
-                start_time = request_start_times.get(request_id)
-                latency = time.time() - start_time if start_time is not None else None
+    def _on_connection_open(self, connection):
+        log_metric(
+            "rabbitmq_connect",
+            status="success",
+            extra_info="publisher",
+            microservice_id="-",
+            failed_microservices=[],
+        )
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, error):
+        log_metric(
+            "rabbitmq_connect",
+            status="failed",
+            extra_info=f"publisher: {error}",
+            microservice_id="-",
+            failed_microservices=[],
+        )
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        log_metric(
+            "publisher_error",
+            status="connection_closed",
+            extra_info=str(reason),
+            microservice_id="-",
+            failed_microservices=[],
+        )
+        self._ready = False
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        channel.add_on_close_callback(self._on_channel_closed)
+        if not self._confirms:
+            self._declare_exchanges(list(self._exchanges))
+            return
+        self._tracker.reset()
+        channel.add_on_return_callback(self._on_return)
+        channel.confirm_delivery(
+            ack_nack_callback=self._on_confirm,
+            callback=lambda _frame: self._declare_exchanges(list(self._exchanges)),
+        )
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        self._tracker.confirmed(
+            method.delivery_tag,
+            method.multiple,
+            isinstance(method, pika.spec.Basic.Ack),
+        )
+
+    def _on_return(self, channel, method, properties, body):
+        self._tracker.returned(method.routing_key, properties)
+
+    def _on_channel_closed(self, channel, reason):
+        self._ready = False
+        # Lo publicado sin confirmar pudo perderse con el canal
+        self._tracker.fail_all()
+        with self._lock:
+            connection = self._connection
+        if connection is not None and connection.is_open:
+            connection.close()
+
+    def _declare_exchanges(self, remaining):
+        if not remaining:
+            self._ready = True
+            self._drain()
+            return
+        exchange, exchange_type = remaining[0]
+        self._channel.exchange_declare(
+            exchange=exchange,
+            exchange_type=exchange_type,
+            durable=True,
+            callback=lambda _frame: self._declare_exchanges(remaining[1:]),
+        )
 
-                # Registro de la respuesta individual
+    def _drain(self):
+        # Corre siempre en el hilo del ioloop
+        while self._ready:
+            try:
+                message = self._outbox.get_nowait()
+            except queue.Empty:
+                return
+            if not publish_request(
+                self._channel, self._tracker, self._confirms, *message
+            ):
+                # Reintentar tras la reconexión
+                self._outbox.put(message)
+                return
+
+
+class RabbitMQTransport:
+    """Transporte por defecto: requests y respuestas por RabbitMQ.
+
+    Un transporte expone:
+      start()                                  arrancar conexiones de fondo
+      publish(routing_key, body, properties, confirm=None)
+                                               enviar una request a una instancia;
+                                               si el transporte confirma, llama a
+                                               confirm.ack() o confirm.fail(reason)
+      consume(queue_name, on_message)          bucle bloqueante de respuestas;
+                                               on_message(body, properties)
+                                               devuelve ACK, REJECT o REQUEUE
+
+    local_stack.py implementa la misma interfaz en proceso, sin broker.
+    """
+
+    def __init__(self, publisher, reconnect_delay=5):
+        self.publisher = publisher
+        self.reconnect_delay = reconnect_delay
+
+    def start(self):
+        self.publisher.start()
+
+    def publish(self, routing_key, body, properties, confirm=None):
+        self.publisher.publish(
+            exchange="requests",
+            routing_key=routing_key,
+            body=body,
+            properties=properties,
+            confirm=confirm,
+        )
+
+    def consume(self, queue_name, on_message):
+        def callback(ch, method, properties, body):
+            outcome = on_message(body, properties)
+            if outcome == ACK:
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+            else:
+                ch.basic_nack(
+                    delivery_tag=method.delivery_tag, requeue=outcome == REQUEUE
+                )
+
+        while True:
+            try:
+                connection = get_rabbitmq_connection()
+                channel = connection.channel()
+                # Cola exclusiva: desaparece con la conexión y se redeclara al reconectar
+                channel.queue_declare(
+                    queue=queue_name, exclusive=True, auto_delete=True
+                )
+                channel.basic_consume(queue=queue_name, on_message_callback=callback)
                 log_metric(
-                    "microservice_response",
-                    request_id=request_id,
-                    status="received",
-                    extra_info=response_data,
-                    microservice_id=microservice_id,
+                    "consumer_ready",
+                    status="waiting_for_responses",
+                    microservice_id="-",
                     failed_microservices=[],
                 )
-
-                # Registro de que se almacenó y la latencia
+                channel.start_consuming()
+            except Exception as e:
                 log_metric(
-                    "response_received",
-                    request_id=request_id,
-                    status="stored",
-                    extra_info=(
-                        f"from microservice {microservice_id}, total {len(responses[request_id])}, latency={latency:.3f}s"
-                        if latency
-                        else f"from microservice {microservice_id}, total {len(responses[request_id])}"
-                    ),
-                    microservice_id=microservice_id,
+                    "consumer_error",
+                    status="connection_failed",
+                    extra_info=str(e),
+                    microservice_id="-",
                     failed_microservices=[],
                 )
+                time.sleep(self.reconnect_delay)
 
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-        except json.JSONDecodeError as e:
-            log_metric(
-                "response_error",
-                status="json_decode_error",
-                extra_info=str(e),
-                microservice_id="-",
-                failed_microservices=[],
-            )
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
-        except Exception as e:
-            log_metric(
-                "response_error",
-                status="processing_error",
-                extra_info=str(e),
-                microservice_id="-",
-                failed_microservices=[],
-            )
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
 
-    while True:
-        try:
-            connection = get_rabbitmq_connection()
-            channel = connection.channel()
-            channel.exchange_declare(
-                exchange="responses", exchange_type="direct", durable=True
-            )
-            channel.queue_declare(queue="validador_responses", durable=True)
-            channel.queue_bind(
-                exchange="responses",
-                queue="validador_responses",
-                routing_key="validador",
-            )
-            channel.basic_consume(
-                queue="validador_responses", on_message_callback=callback
-            )
-            log_metric(
-                "consumer_ready",
-                status="waiting_for_responses",
-                microservice_id="-",
-                failed_microservices=[],
-            )
-            channel.start_consuming()
-        except Exception as e:
-            log_metric(
-                "consumer_error",
-                status="connection_failed",
-                extra_info=str(e),
-                microservice_id="-",
-                failed_microservices=[],
-            )
-            time.sleep(5)
+publisher = RabbitPublisher(
+    exchanges=[("requests", "direct")], confirms=PUBLISHER_CONFIRMS
+)
+transport = RabbitMQTransport(publisher)
+
+
+def setup_rabbitmq_consumer():
+    """Bucle del consumidor de respuestas sobre el transporte configurado"""
+    transport.consume(get_reply_queue(), handle_response)
 
 
 @app.route("/process", methods=["POST"])
 def process_request():
-    global current_request_id
-
     try:
         data = request.get_json()
-        if not data:
-            log_metric(
-                "process_request",
-                status="failed",
-                extra_info="No JSON data provided",
-                microservice_id="-",
-                failed_microservices=[],
-            )
-            return jsonify({"error": "No JSON data provided"}), 400
+        timeout = check_request(data, request.headers.get(DEADLINE_HEADER))
+        (body, status_code), source = single_flight.do(
+            coalescing_key(data, timeout), lambda: run_consensus(data, timeout)
+        )
+        log_coalesced(body, source)
+        return jsonify(body), status_code
 
-        current_request_id += 1
-        request_id = str(current_request_id)
-        request_start_times[request_id] = time.time()
+    except InvalidRequest as e:
+        return jsonify({"error": str(e)}), 400
+    except StoreFull as e:
         log_metric(
-            "request_start",
-            request_id=request_id,
-            status="received",
+            "process_request",
+            status="rejected",
+            extra_info=str(e),
             microservice_id="-",
             failed_microservices=[],
         )
-
-        target_microservices = determine_target_microservices(data)
-        send_to_rabbitmq(request_id, target_microservices, data)
-
-        time.sleep(0.3)
-        max_wait_time = 8
-        wait_interval = 0.1
-        start_time = time.time()
-
+        return jsonify({"error": "Too many pending requests"}), 503
+    except Exception as e:
         log_metric(
             "process_request",
-            request_id=request_id,
-            status="waiting_responses",
-            extra_info=f"expecting {len(target_microservices)}",
+            status="error",
+            extra_info=str(e),
             microservice_id="-",
             failed_microservices=[],
         )
+        return jsonify({"error": str(e)}), 500
 
-        def normalize_response(resp):
-            r = resp["response"].copy()
-            r.pop("microservice_id", None)
-            r["data"] = r.get("data", {}).copy()
-            r["data"].pop("instance", None)
-            r["data"].pop("timestamp", None)
-            return json.dumps(r, sort_keys=True)
-
-        while time.time() - start_time < max_wait_time:
-            with responses_lock:
-                request_responses = responses.get(request_id, [])
-                normalized = [normalize_response(r) for r in request_responses]
-                counts = Counter(normalized)
-                most_common = counts.most_common(1)
-
-                if most_common and most_common[0][1] >= 2:
-                    idx = normalized.index(most_common[0][0])
-                    valid_response = request_responses[idx]
-
-                    if request_id in responses:
-                        del responses[request_id]
-
-                    final_wait_time = time.time() - start_time
-
-                    log_metric(
-                        "vote_result",
-                        request_id=request_id,
-                        status="consensus_reached",
-                        extra_info=valid_response["response"],
-                        microservice_id="-",
-                        failed_microservices=[],
-                    )
-
-                    log_metric(
-                        "latency_summary",
-                        request_id=request_id,
-                        status="success",
-                        extra_info=f"responses={len(request_responses)}, total_time={final_wait_time:.2f}s",
-                        microservice_id="-",
-                        failed_microservices=[],
-                    )
-
-                    return jsonify(
-                        {
-                            "request_id": request_id,
-                            "response": valid_response["response"],
-                            "wait_time": f"{final_wait_time:.2f}s",
-                        }
-                    )
-
-                if len(request_responses) >= len(target_microservices):
-                    break
-
-            time.sleep(wait_interval)
-
-        with responses_lock:
-            request_responses = responses.get(request_id, [])
-            if request_id in responses:
-                del responses[request_id]
-
-        final_wait_time = time.time() - start_time
-        all_microservices = set(target_microservices)
-        responded_services = set(r["microservice_id"] for r in request_responses)
-        failed_microservices = list(all_microservices - responded_services)
 
-        log_metric(
-            "vote_result",
-            request_id=request_id,
-            status="no_consensus",
-            extra_info="No consensus reached",
-            microservice_id="-",
-            failed_microservices=failed_microservices,
+def run_consensus(data, timeout):
+    """Fan-out y votación de una consulta; devuelve (cuerpo, status)"""
+    return run_steps(consensus_steps(transport, PendingRequest, data, timeout))
+
+
+@app.route("/process/batch", methods=["POST"])
+def process_batch_request():
+    """Consulta de muchos product_id con un solo mensaje por instancia"""
+    try:
+        data = request.get_json()
+        product_ids, timeout = check_batch_request(
+            data, request.headers.get(DEADLINE_HEADER)
+        )
+        body, status_code = run_steps(
+            batch_steps(transport, PendingRequest, data, product_ids, timeout)
         )
+        return jsonify(body), status_code
 
+    except InvalidRequest as e:
+        return jsonify({"error": str(e)}), 400
+    except StoreFull as e:
         log_metric(
-            "latency_summary",
-            request_id=request_id,
-            status="failed",
-            extra_info=f"responses={len(request_responses)}, total_time={final_wait_time:.2f}s",
+            "process_batch_request",
+            status="rejected",
+            extra_info=str(e),
             microservice_id="-",
             failed_microservices=[],
         )
-
-        return (
-            jsonify(
-                {
-                    "error": "No se obtuvo consenso entre los microservicios de inventario.",
-                    "request_id": request_id,
-                    "responses": request_responses,
-                    "failed_microservices": failed_microservices,
-                    "wait_time": f"{final_wait_time:.2f}s",
-                }
-            ),
-            500,
-        )
-
+        return jsonify({"error": "Too many pending requests"}), 503
     except Exception as e:
         log_metric(
-            "process_request",
+            "process_batch_request",
             status="error",
             extra_info=str(e),
             microservice_id="-",
@@ -366,80 +438,39 @@ def process_request():
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/health", methods=["GET"])
-def health_check():
-    log_metric(
-        "health_check", status="ok", microservice_id="-", failed_microservices=[]
-    )
-    return jsonify(
-        {"status": "healthy", "service": "validador", "timestamp": time.time()}
-    )
+# Latencia de las consultas, con el status final de cada una
+TIMED_ENDPOINTS = ("/process", "/process/batch")
 
 
-def determine_target_microservices(data):
-    if "product_id" in data:
-        return [1, 2, 3]
-    elif "category" in data:
-        return [1, 2]
-    else:
-        return [1]
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
 
 
-def send_to_rabbitmq(request_id, target_microservices, data):
-    try:
-        connection = get_rabbitmq_connection()
-        channel = connection.channel()
-        channel.exchange_declare(
-            exchange="requests", exchange_type="direct", durable=True
-        )
+@app.after_request
+def observe_latency(response):
+    if request.path in TIMED_ENDPOINTS and "started" in g:
+        live_metrics.REQUEST_LATENCY.labels(
+            request.path, str(response.status_code)
+        ).observe(time.perf_counter() - g.started)
+    return response
 
-        for microservice_id in target_microservices:
-            send_time = time.time()
-            message = {
-                "request_id": request_id,
-                "data": data,
-                "response_routing_key": "validador",
-            }
-            channel.basic_publish(
-                exchange="requests",
-                routing_key=f"microservice_{microservice_id}",
-                body=json.dumps(message),
-                properties=pika.BasicProperties(
-                    delivery_mode=2, content_type="application/json"
-                ),
-            )
-            log_metric(
-                "send_to_rabbitmq",
-                request_id=request_id,
-                status="sent",
-                extra_info=f"to microservice {microservice_id}, send_time={send_time}",
-                microservice_id=microservice_id,
-                failed_microservices=[],
-            )
 
-        log_metric(
-            "send_batch_complete",
-            request_id=request_id,
-            status="done",
-            extra_info=f"sent {len(target_microservices)} messages",
-            microservice_id="-",
-            failed_microservices=[],
-        )
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    body, content_type = live_metrics.render()
+    return Response(body, content_type=content_type)
 
-        connection.close()
-    except Exception as e:
-        log_metric(
-            "send_to_rabbitmq",
-            request_id=request_id,
-            status="error",
-            extra_info=str(e),
-            microservice_id="-",
-            failed_microservices=[],
-        )
-        raise
+
+@app.route("/health", methods=["GET"])
+def health_check():
+    return jsonify(health_status(single_flight))
 
 
 if __name__ == "__main__":
+    # docker stop envía SIGTERM: salir limpiamente para que corra atexit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    transport.start()
     rabbitmq_thread = threading.Thread(target=setup_rabbitmq_consumer, daemon=True)
     rabbitmq_thread.start()
     app.run(host="0.0.0.0", port=5000, debug=False, use_reloader=False)
@@ -0,0 +1,342 @@
+"""Modo de servicio asíncrono del validador (ASGI).
+
+Expone los mismos /process, /process/batch y /health que app.py, pero cada
+request pendiente es una corrutina esperando un asyncio.Event en lugar de
+un hilo bloqueado, y la mensajería usa la AsyncioConnection de pika sobre el
+mismo event loop. La votación, los deadlines y el manejo de las respuestas
+son los de consensus.py, igual que en app.py. Se ejecuta con:
+
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import json
+import time
+
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+import pika
+
+import live_metrics
+from coalescing import AsyncSingleFlight, single_flight_from_env
+from pending_store import StoreFull
+from publisher_confirms import ConfirmTracker
+
+from app import get_rabbitmq_parameters, publish_request
+from consensus import (
+    ACK,
+    DEADLINE_HEADER,
+    PUBLISHER_CONFIRMS,
+    REQUEUE,
+    AsyncPendingRequest,
+    InvalidRequest,
+    batch_steps,
+    check_batch_request,
+    check_request,
+    coalescing_key,
+    consensus_steps,
+    get_reply_queue,
+    handle_response,
+    health_status,
+    log_coalesced,
+    log_metric,
+    run_steps_async,
+)
+
+
+class AsyncRabbitClient:
+    """Publicación y consumo de respuestas sobre una AsyncioConnection.
+
+    Todo corre en el event loop; las requests pendientes viven en el mismo
+    pending_store acotado que usa app.py. Si la conexión cae se reintenta cada
+    `reconnect_delay` segundos y lo publicado mientras tanto se envía al
+    reconectar. Con confirms=True los acks, nacks y returns del broker
+    resuelven el Confirm de cada mensaje, como en app.RabbitPublisher.
+    """
+
+    def __init__(self, reconnect_delay=5, confirms=False):
+        self.reconnect_delay = reconnect_delay
+        self.confirms = confirms
+        self._tracker = ConfirmTracker()
+        self._connection = None
+        self._channel = None
+        self._ready = False
+        self._outbox = []
+        self._closing = False
+
+    def connect(self):
+        self._connection = AsyncioConnection(
+            get_rabbitmq_parameters(),
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_open_error,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=asyncio.get_running_loop(),
+        )
+
+    def close(self):
+        self._closing = True
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+
+    def publish(self, routing_key, body, properties, confirm=None):
+        message = (routing_key, body, properties, confirm)
+        if self._ready and publish_request(
+            self._channel, self._tracker, self.confirms, "requests", *message
+        ):
+            return
+        # Sin canal, o se cayó al publicar: se envía al reconectar
+        self._ready = False
+        self._outbox.append(message)
+
+    def _schedule_reconnect(self):
+        self._ready = False
+        self._channel = None
+        if not self._closing:
+            asyncio.get_running_loop().call_later(self.reconnect_delay, self.connect)
+
+    def _on_connection_open(self, connection):
+        log_metric(
+            "rabbitmq_connect",
+            status="success",
+            extra_info="asyncio",
+            microservice_id="-",
+            failed_microservices=[],
+        )
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, error):
+        log_metric(
+            "rabbitmq_connect",
+            status="failed",
+            extra_info=f"asyncio: {error}",
+            microservice_id="-",
+            failed_microservices=[],
+        )
+        self._schedule_reconnect()
+
+    def _on_connection_closed(self, connection, reason):
+        log_metric(
+            "consumer_error",
+            status="connection_failed",
+            extra_info=str(reason),
+            microservice_id="-",
+            failed_microservices=[],
+        )
+        self._schedule_reconnect()
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        channel.add_on_close_callback(self._on_channel_closed)
+        if not self.confirms:
+            self._declare_exchange()
+            return
+        self._tracker.reset()
+        channel.add_on_return_callback(self._on_return)
+        channel.confirm_delivery(
+            ack_nack_callback=self._on_confirm,
+            callback=lambda _frame: self._declare_exchange(),
+        )
+
+    def _declare_exchange(self):
+        self._channel.exchange_declare(
+            exchange="requests",
+            exchange_type="direct",
+            durable=True,
+            callback=self._on_exchange_declared,
+        )
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        self._tracker.confirmed(
+            method.delivery_tag,
+            method.multiple,
+            isinstance(method, pika.spec.Basic.Ack),
+        )
+
+    def _on_return(self, channel, method, properties, body):
+        self._tracker.returned(method.routing_key, properties)
+
+    def _on_channel_closed(self, channel, reason):
+        self._ready = False
+        self._tracker.fail_all()
+        # Cerrar la conexión fuerza la reconexión completa
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+
+    def _on_exchange_declared(self, _frame):
+        # Cola reply_to exclusiva de este proceso
+        self._channel.queue_declare(
+            queue=get_reply_queue(),
+            exclusive=True,
+            auto_delete=True,
+            callback=self._on_reply_queue_declared,
+        )
+
+    def _on_reply_queue_declared(self, _frame):
+        self._channel.basic_consume(
+            queue=get_reply_queue(), on_message_callback=self._on_message
+        )
+        self._ready = True
+        outbox, self._outbox = self._outbox, []
+        for routing_key, body, properties, confirm in outbox:
+            self.publish(routing_key, body, properties, confirm)
+        log_metric(
+            "consumer_ready",
+            status="waiting_for_responses",
+            microservice_id="-",
+            failed_microservices=[],
+        )
+
+    def _on_message(self, channel, method, properties, body):
+        # Mismo manejo que el consumidor de app.py; aquí solo el ack o nack
+        outcome = handle_response(body, properties)
+        if outcome == ACK:
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+        else:
+            channel.basic_nack(
+                delivery_tag=method.delivery_tag, requeue=outcome == REQUEUE
+            )
+
+
+client = AsyncRabbitClient(confirms=PUBLISHER_CONFIRMS)
+single_flight = single_flight_from_env(
+    AsyncSingleFlight, cacheable=lambda result: result[1] == 200
+)
+
+
+async def process_request(data, headers):
+    timeout = check_request(data, headers.get(DEADLINE_HEADER.lower()))
+    (body, status_code), source = await single_flight.do(
+        coalescing_key(data, timeout), lambda: run_consensus(data, timeout)
+    )
+    log_coalesced(body, source)
+    return body, status_code
+
+
+async def run_consensus(data, timeout):
+    """Fan-out y votación de una consulta; devuelve (cuerpo, status)"""
+    return await run_steps_async(
+        consensus_steps(client, AsyncPendingRequest, data, timeout)
+    )
+
+
+async def process_batch_request(data, headers):
+    product_ids, timeout = check_batch_request(
+        data, headers.get(DEADLINE_HEADER.lower())
+    )
+    return await run_steps_async(
+        batch_steps(client, AsyncPendingRequest, data, product_ids, timeout)
+    )
+
+
+async def health_check(data, headers):
+    return health_status(single_flight), 200
+
+
+async def metrics(data, headers):
+    return live_metrics.render(), 200
+
+
+ROUTES = {
+    ("POST", "/process"): process_request,
+    ("POST", "/process/batch"): process_batch_request,
+    ("GET", "/health"): health_check,
+    ("GET", "/metrics"): metrics,
+}
+
+# Latencia de las consultas, con el status final de cada una
+TIMED_ENDPOINTS = ("/process", "/process/batch")
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def send_bytes(send, payload, content_type, status_code):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [
+                (b"content-type", content_type.encode()),
+                (b"content-length", str(len(payload)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": payload})
+
+
+async def send_json(send, body, status_code):
+    # Mismo formato que jsonify de Flask (claves ordenadas y compacto)
+    payload = (json.dumps(body, sort_keys=True, separators=(",", ":")) + "\n").encode(
+        "utf-8"
+    )
+    await send_bytes(send, payload, "application/json", status_code)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            client.connect()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            client.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+
+    handler = ROUTES.get((scope["method"], scope["path"]))
+    if handler is None:
+        await read_body(receive)
+        await send_json(send, {"error": "Not found"}, 404)
+        return
+
+    started = time.perf_counter()
+    raw = await read_body(receive)
+    headers = {
+        name.decode("latin-1").lower(): value.decode("latin-1")
+        for name, value in scope.get("headers", [])
+    }
+    try:
+        data = json.loads(raw) if raw else None
+        body, status_code = await handler(data, headers)
+    except InvalidRequest as e:
+        body, status_code = {"error": str(e)}, 400
+    except StoreFull as e:
+        log_metric(
+            "process_request",
+            status="rejected",
+            extra_info=str(e),
+            microservice_id="-",
+            failed_microservices=[],
+        )
+        body, status_code = {"error": "Too many pending requests"}, 503
+    except Exception as e:
+        log_metric(
+            "process_request",
+            status="error",
+            extra_info=str(e),
+            microservice_id="-",
+            failed_microservices=[],
+        )
+        body, status_code = {"error": str(e)}, 500
+    if isinstance(body, tuple):
+        # /metrics: (texto, content_type) en lugar de JSON
+        await send_bytes(send, *body, status_code)
+    else:
+        await send_json(send, body, status_code)
+    if scope["path"] in TIMED_ENDPOINTS:
+        live_metrics.REQUEST_LATENCY.labels(scope["path"], str(status_code)).observe(
+            time.perf_counter() - started
+        )
@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Estado de salud de un microservicio de inventario.
+
+    Se abre tras `threshold` timeouts seguidos sin ninguna respuesta en el
+    medio; abierto, las requests no lo consultan. Pasados `cooldown`
+    segundos una sola request lo prueba (half_open): si responde se cierra,
+    si vuelve a vencer su deadline se reabre. Si la prueba no se resuelve en
+    otro `cooldown` se permite una nueva.
+    """
+
+    def __init__(self, threshold=3, cooldown=10.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            # Abierto o con una prueba en curso: esperar el cooldown
+            since = self.opened_at if self.state == OPEN else self.probe_at
+            if now - since < self.cooldown:
+                return False
+            self.state = HALF_OPEN
+            self.probe_at = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                self.state = OPEN
+                self.opened_at = now
+
+
+class CircuitBreakers:
+    """Un CircuitBreaker por microservicio, creado al primer uso"""
+
+    def __init__(self, enabled=True, threshold=3, cooldown=10.0):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def _get(self, microservice_id):
+        breaker = self._breakers.get(microservice_id)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(
+                    microservice_id, CircuitBreaker(self.threshold, self.cooldown)
+                )
+        return breaker
+
+    def available(self, targets):
+        """(a consultar, salteados) según el estado de cada circuito"""
+        if not self.enabled:
+            return list(targets), []
+        allowed, skipped = [], []
+        for microservice_id in targets:
+            if self._get(microservice_id).allow():
+                allowed.append(microservice_id)
+            else:
+                skipped.append(microservice_id)
+        return allowed, skipped
+
+    def record_success(self, microservice_id):
+        if self.enabled:
+            self._get(microservice_id).record_success()
+
+    def record_failures(self, microservice_ids):
+        if self.enabled:
+            for microservice_id in microservice_ids:
+                self._get(microservice_id).record_failure()
+
+    def stats(self):
+        return {
+            str(ms): {"state": breaker.state, "failures": breaker.failures}
+            for ms, breaker in sorted(self._breakers.items())
+        }
+
+
+def circuit_breakers_from_env():
+    """CIRCUIT_BREAKER=0 desactiva el corte de instancias caídas"""
+    return CircuitBreakers(
+        enabled=os.getenv("CIRCUIT_BREAKER", "1") == "1",
+        threshold=int(os.getenv("CIRCUIT_BREAKER_THRESHOLD", "3")),
+        cooldown=float(os.getenv("CIRCUIT_BREAKER_COOLDOWN", "10")),
+    )
@@ -0,0 +1,175 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+
+def request_key(data):
+    """Clave normalizada del payload: mismo JSON con claves ordenadas"""
+    return json.dumps(data, sort_keys=True, separators=(",", ":"))
+
+
+class ConsensusCache:
+    """Caché TTL corta de resultados con consenso, acotada a max_entries"""
+
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                # Descartar la entrada más antigua (orden de inserción)
+                del self._entries[next(iter(self._entries))]
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Agrupa consultas idénticas en curso en una sola ejecución.
+
+    do(key, fn) ejecuta fn una vez por clave; las llamadas concurrentes con
+    la misma clave esperan y reciben el mismo resultado. Con caché, los
+    resultados con `cacheable(result)` se reutilizan durante el TTL.
+    """
+
+    def __init__(self, enabled=True, cache=None, cacheable=None):
+        self.enabled = enabled
+        self.cache = cache
+        self.cacheable = cacheable or (lambda result: True)
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._flights),
+                "cached": len(self.cache) if self.cache is not None else 0,
+            }
+
+    def _cached(self, key):
+        if self.cache is None:
+            return None
+        result = self.cache.get(key)
+        if result is not None:
+            with self._lock:
+                self.hits += 1
+        return result
+
+    def _store(self, key, result):
+        if self.cache is not None and self.cacheable(result):
+            self.cache.put(key, result)
+
+    def do(self, key, fn):
+        """Devuelve (resultado, origen) con origen "leader", "coalesced" o "cache" """
+        if not self.enabled:
+            return fn(), "leader"
+        result = self._cached(key)
+        if result is not None:
+            return result, "cache"
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, "coalesced"
+
+        try:
+            flight.result = fn()
+            self._store(key, flight.result)
+            return flight.result, "leader"
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+
+class AsyncSingleFlight(SingleFlight):
+    """Variante para el modo ASGI: los que esperan comparten un Future"""
+
+    async def do(self, key, coro_fn):
+        if not self.enabled:
+            return await coro_fn(), "leader"
+        result = self._cached(key)
+        if result is not None:
+            return result, "cache"
+
+        flight = self._flights.get(key)
+        if flight is not None:
+            with self._lock:
+                self.coalesced += 1
+            # shield: si este cliente se cancela no cancela a los demás
+            return await asyncio.shield(flight), "coalesced"
+
+        flight = self._flights[key] = asyncio.get_running_loop().create_future()
+        with self._lock:
+            self.misses += 1
+        try:
+            result = await coro_fn()
+            self._store(key, result)
+            flight.set_result(result)
+            return result, "leader"
+        except BaseException as e:
+            flight.set_exception(e)
+            # Evitar el aviso de excepción no recuperada si nadie esperaba
+            flight.exception()
+            raise
+        finally:
+            self._flights.pop(key, None)
+
+
+def single_flight_from_env(cls=SingleFlight, cacheable=None):
+    """COALESCE_REQUESTS=0 desactiva la agrupación; QUERY_CACHE_TTL_MS > 0
+    activa la caché de consenso (QUERY_CACHE_MAX_ENTRIES entradas)"""
+    ttl_ms = float(os.getenv("QUERY_CACHE_TTL_MS", "0"))
+    cache = None
+    if ttl_ms > 0:
+        cache = ConsensusCache(
+            ttl_ms / 1000.0, int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "10000"))
+        )
+    return cls(
+        enabled=os.getenv("COALESCE_REQUESTS", "1") == "1",
+        cache=cache,
+        cacheable=cacheable,
+    )
@@ -0,0 +1,1025 @@
+"""Consulta con votación del validador, compartida por sus dos modos.
+
+app.py (Flask, un hilo por request) y asgi_app.py (una corrutina por
+request) reciben, publican y esperan de forma distinta, pero el resto es lo
+mismo y vive aquí: el conteo de votos de cada request pendiente, el manejo
+de las respuestas del inventario, los deadlines, circuitos y confirms, y el
+flujo de /process y /process/batch. Cada modo solo aporta su transporte y
+su forma de esperar (ver consensus_steps).
+"""
+
+import asyncio
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+import uuid
+
+import pika
+
+from metrics_log import MetricsWriter, SegmentWriter
+from coalescing import request_key
+from circuit_breaker import circuit_breakers_from_env
+from deadlines import deadline_policy_from_env
+from hedging import hedge_policy_from_env
+import live_metrics
+import message_codec
+from pending_store import PendingStore
+from publisher_confirms import FanoutConfirms
+from voting import BatchVoteTally, VoteTally, strategy_from_env
+
+METRICS_FILE = "metrics.csv"
+
+# Tiempo máximo de espera de respuestas por request (segundos)
+MAX_WAIT_TIME = 8
+
+# Codificación de requests (MESSAGE_ENCODING): msgpack con sobre plano o
+# JSON; el inventario responde con la misma
+MESSAGE_CONTENT_TYPE = message_codec.content_type_from_env()
+
+# Requests persistentes (delivery_mode=2, por defecto) o transitorias con
+# TRANSIENT_MESSAGES=1: es tráfico RPC que no sirve tras el deadline, así
+# que no hace falta escribirlo a disco. El inventario responde con el mismo
+DELIVERY_MODE = 1 if os.getenv("TRANSIENT_MESSAGES", "0") == "1" else 2
+
+# Header AMQP con el deadline absoluto de la request, en milisegundos epoch
+# enteros: el inventario descarta sin procesar lo que llega vencido
+REQUEST_DEADLINE_HEADER = "x-deadline"
+
+# Publisher confirms (PUBLISHER_CONFIRMS=1, por defecto): el broker confirma
+# cada request en segundo plano y un nack o un return falla ese destino
+# enseguida, sin esperar su deadline
+PUBLISHER_CONFIRMS = os.getenv("PUBLISHER_CONFIRMS", "1") == "1"
+
+# Header opcional con la espera máxima que acepta el cliente (milisegundos)
+DEADLINE_HEADER = "X-Deadline-Ms"
+
+# Requests en espera por request_id. Cada una tiene su propio lock y su
+# conteo de votos; el store está acotado y un barrido de fondo quita las
+# entradas vencidas (deadline + PENDING_GRACE)
+pending_store = PendingStore(
+    max_entries=int(os.getenv("PENDING_MAX_ENTRIES", "10000")),
+    grace=float(os.getenv("PENDING_GRACE", "2")),
+    sweep_interval=float(os.getenv("PENDING_SWEEP_INTERVAL", "1")),
+)
+pending_store.start()
+live_metrics.PENDING_REQUESTS.set_function(lambda: len(pending_store))
+
+# Estrategia de quorum (QUORUM_STRATEGY): first_k, majority o weighted
+quorum_strategy = strategy_from_env()
+
+# Envío escalonado (HEDGED_DISPATCH=1): dos instancias primero y la tercera
+# solo si discrepan o si alguna supera el presupuesto de latencia observado
+hedge_policy = hedge_policy_from_env(quorum_strategy)
+
+# Deadline de cada instancia según su distribución de latencias: vencido,
+# deja de esperarse y, si el quorum ya no es posible, la request termina
+deadline_policy = deadline_policy_from_env(MAX_WAIT_TIME)
+
+# Circuito por microservicio: tras varios deadlines vencidos seguidos la
+# instancia no se consulta hasta que una prueba vuelva a responder
+circuit_breakers = circuit_breakers_from_env()
+
+# Máximo de productos por consulta en /process/batch
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "500"))
+
+# Formato del log: "csv" (por defecto), "binary" o "both"
+METRICS_FORMAT = os.getenv("METRICS_FORMAT", "csv")
+METRICS_SEGMENT_DIR = os.getenv("METRICS_SEGMENT_DIR", "metrics_segments")
+
+# Escritura de métricas en segundo plano: los hilos solo encolan
+metrics_writer = MetricsWriter(
+    METRICS_FILE if METRICS_FORMAT in ("csv", "both") else None,
+    max_queue=int(os.getenv("METRICS_QUEUE_SIZE", "100000")),
+    batch_size=int(os.getenv("METRICS_BATCH_SIZE", "500")),
+    flush_interval=float(os.getenv("METRICS_FLUSH_INTERVAL", "0.5")),
+    max_bytes=int(os.getenv("METRICS_MAX_BYTES", "0")),
+    backup_count=int(os.getenv("METRICS_BACKUP_COUNT", "5")),
+    segment_writer=(
+        SegmentWriter(
+            METRICS_SEGMENT_DIR,
+            max_segment_bytes=int(
+                os.getenv("METRICS_SEGMENT_BYTES", str(64 * 1024 * 1024))
+            ),
+            block_rows=int(os.getenv("METRICS_SEGMENT_BLOCK_ROWS", "4096")),
+            block_interval=float(os.getenv("METRICS_SEGMENT_BLOCK_INTERVAL", "5")),
+        )
+        if METRICS_FORMAT in ("binary", "both")
+        else None
+    ),
+)
+metrics_writer.start()
+# Vaciar la cola al terminar para no perder eventos
+atexit.register(metrics_writer.close)
+
+
+def log_metric(
+    event,
+    request_id=None,
+    status="",
+    extra_info="",
+    microservice_id="-",
+    failed_microservices=None,
+):
+    # La serialización se hace en el hilo del writer, no aquí
+    metrics_writer.submit(
+        (
+            time.time(),
+            event,
+            request_id or "-",
+            status,
+            extra_info,
+            microservice_id,
+            failed_microservices,
+            os.getpid(),
+            threading.get_ident(),
+        )
+    )
+
+
+# Cola de respuestas exclusiva de este proceso: cada réplica o worker recibe
+# solo las respuestas de sus propias requests
+_reply_queue = None
+_reply_queue_pid = None
+_reply_queue_lock = threading.Lock()
+
+
+def get_reply_queue():
+    """Nombre de la cola reply_to de este proceso (nuevo tras un fork)"""
+    global _reply_queue, _reply_queue_pid
+    # Lock: el consumidor y los hilos HTTP deben ver el mismo nombre
+    with _reply_queue_lock:
+        if _reply_queue_pid != os.getpid():
+            _reply_queue = f"validador_replies_{uuid.uuid4().hex}"
+            _reply_queue_pid = os.getpid()
+        return _reply_queue
+
+
+def new_request_id():
+    """Id sin colisiones entre hilos, procesos y nodos; viaja como correlation_id"""
+    return uuid.uuid4().hex
+
+
+# Resultado de un manejador de mensajes; el transporte hace el ack o nack
+ACK = "ack"
+REJECT = "reject"
+REQUEUE = "requeue"
+
+
+def parse_response_message(body, properties=None):
+    """(request_id, microservice_id, response) de un mensaje de inventario"""
+    return message_codec.decode_response(body, properties)
+
+
+def log_response(request_id, microservice_id, response_data, total, start_time):
+    latency = time.time() - start_time if start_time is not None else None
+
+    # Registro de la respuesta individual (fuera del lock)
+    log_metric(
+        "microservice_response",
+        request_id=request_id,
+        status="received",
+        extra_info=response_data,
+        microservice_id=microservice_id,
+        failed_microservices=[],
+    )
+
+    # Registro de que se almacenó y la latencia
+    log_metric(
+        "response_received",
+        request_id=request_id,
+        status="stored",
+        extra_info=(
+            f"from microservice {microservice_id}, total {total}, latency={latency:.3f}s"
+            if latency
+            else f"from microservice {microservice_id}, total {total}"
+        ),
+        microservice_id=microservice_id,
+        failed_microservices=[],
+    )
+
+
+class PendingRequest:
+    """Request en espera: conteo de votos propio y evento para el hilo HTTP.
+
+    El consumidor llama a add() una vez por respuesta; el evento solo se
+    activa cuando la votación terminó (decisión, todas las respuestas o
+    quorum imposible). Cada instancia consultada tiene su deadline según
+    `budget(microservice_id)`; vencido, deja de esperarse. Tampoco se espera
+    a las que el broker no aceptó (`undelivered`).
+    """
+
+    def __init__(self, tally, budget=None):
+        self.tally = tally
+        self.budget = budget or (lambda microservice_id: MAX_WAIT_TIME)
+        self.start_time = time.time()
+        self.sent_at = {}
+        self.deadlines = {}
+        self.expired = []
+        self.undelivered = []
+        self.event = threading.Event()
+        self._lock = threading.Lock()
+
+    def dispatch(self, microservice_ids):
+        """Registrar instancias consultadas más tarde (envío escalonado)"""
+        now = time.time()
+        with self._lock:
+            for microservice_id in microservice_ids:
+                self.sent_at[microservice_id] = now
+                self.deadlines[microservice_id] = now + self.budget(microservice_id)
+            self.tally.dispatch(microservice_ids)
+            self._update_event()
+
+    def exclude(self, microservice_ids):
+        """No esperar a estas instancias (circuito abierto)"""
+        with self._lock:
+            self.tally.exclude(microservice_ids)
+            self._update_event()
+
+    def undeliverable(self, microservice_id):
+        """El broker rechazó o no pudo enrutar la request a esta instancia"""
+        with self._lock:
+            self.undelivered.append(microservice_id)
+            self.tally.exclude([microservice_id])
+            self._update_event()
+
+    def expire(self, now):
+        """Dejar de esperar a las instancias con el deadline vencido"""
+        with self._lock:
+            late = [
+                ms
+                for ms, deadline in self.deadlines.items()
+                if deadline <= now
+                and ms not in self.tally.responded
+                and ms not in self.tally.excluded
+            ]
+            if late:
+                self.expired.extend(late)
+                self.tally.exclude(late)
+                self._update_event()
+        return late
+
+    def next_deadline(self):
+        with self._lock:
+            waiting = [
+                deadline
+                for ms, deadline in self.deadlines.items()
+                if ms not in self.tally.responded and ms not in self.tally.excluded
+            ]
+        return min(waiting, default=None)
+
+    def _update_event(self):
+        # Con el lock tomado
+        if self.tally.finished:
+            self.event.set()
+        else:
+            self.event.clear()
+
+    def latency(self, microservice_id):
+        return time.time() - self.sent_at.get(microservice_id, self.start_time)
+
+    def add(self, response):
+        with self._lock:
+            self.tally.add(response)
+            self._update_event()
+            return len(self.tally.responses)
+
+    def wait_until(self, deadline):
+        """Esperar hasta que termine la votación o llegue `deadline` (epoch),
+        despertando en cada deadline de instancia para dejar de esperarla"""
+        while True:
+            now = time.time()
+            self.expire(now)
+            if self.event.is_set() or now >= deadline:
+                return
+            wake = min(deadline, self.next_deadline() or deadline)
+            self.event.wait(max(wake - now, 0))
+
+    def responses(self):
+        with self._lock:
+            return list(self.tally.responses)
+
+    def decided(self):
+        """Productos decididos hasta ahora (solo para BatchVoteTally)"""
+        with self._lock:
+            return dict(self.tally.decided)
+
+
+class AsyncPendingRequest(PendingRequest):
+    """PendingRequest para asgi_app.py: el consumidor y la corrutina corren
+    en el mismo event loop, así que no hace falta lock y se espera con await"""
+
+    def __init__(self, tally, budget=None):
+        super().__init__(tally, budget)
+        # Se crea dentro de una corrutina: en 3.9 el evento toma ese loop
+        self.event = asyncio.Event()
+        self._lock = contextlib.nullcontext()
+
+    async def wait_until(self, deadline):
+        """Como PendingRequest.wait_until, sin bloquear el loop"""
+        while True:
+            now = time.time()
+            self.expire(now)
+            if self.event.is_set() or now >= deadline:
+                return
+            wake = min(deadline, self.next_deadline() or deadline)
+            try:
+                await asyncio.wait_for(self.event.wait(), max(wake - now, 0))
+            except asyncio.TimeoutError:
+                pass
+
+
+def count_timeouts(failed_microservices):
+    for microservice_id in failed_microservices:
+        live_metrics.TIMEOUTS.labels(str(microservice_id)).inc()
+
+
+def consensus_result(request_id, valid_response, request_responses, final_wait_time):
+    """Registrar el consenso y devolver (cuerpo, status) de /process"""
+    live_metrics.VOTE_OUTCOMES.labels("consensus_reached").inc()
+    log_metric(
+        "vote_result",
+        request_id=request_id,
+        status="consensus_reached",
+        extra_info=valid_response["response"],
+        microservice_id="-",
+        failed_microservices=[],
+    )
+
+    log_metric(
+        "latency_summary",
+        request_id=request_id,
+        status="success",
+        extra_info=f"responses={len(request_responses)}, total_time={final_wait_time:.2f}s",
+        microservice_id="-",
+        failed_microservices=[],
+    )
+
+    return (
+        {
+            "request_id": request_id,
+            "response": valid_response["response"],
+            "wait_time": f"{final_wait_time:.2f}s",
+        },
+        200,
+    )
+
+
+def no_consensus_result(
+    request_id, target_microservices, request_responses, final_wait_time
+):
+    """Registrar la falta de consenso y devolver (cuerpo, status) de /process"""
+    all_microservices = set(target_microservices)
+    responded_services = set(r["microservice_id"] for r in request_responses)
+    failed_microservices = list(all_microservices - responded_services)
+    live_metrics.VOTE_OUTCOMES.labels("no_consensus").inc()
+    count_timeouts(failed_microservices)
+
+    log_metric(
+        "vote_result",
+        request_id=request_id,
+        status="no_consensus",
+        extra_info="No consensus reached",
+        microservice_id="-",
+        failed_microservices=failed_microservices,
+    )
+
+    log_metric(
+        "latency_summary",
+        request_id=request_id,
+        status="failed",
+        extra_info=f"responses={len(request_responses)}, total_time={final_wait_time:.2f}s",
+        microservice_id="-",
+        failed_microservices=[],
+    )
+
+    return (
+        {
+            "error": "No se obtuvo consenso entre los microservicios de inventario.",
+            "request_id": request_id,
+            "responses": request_responses,
+            "failed_microservices": failed_microservices,
+            "wait_time": f"{final_wait_time:.2f}s",
+        },
+        500,
+    )
+
+
+def handle_response(body, properties):
+    """Registrar la respuesta de un inventario; devuelve ACK, REJECT o REQUEUE"""
+    started = time.perf_counter()
+    received = time.time()
+    try:
+        request_id, microservice_id, response_data = parse_response_message(
+            body, properties
+        )
+        log_stage_spans(request_id, microservice_id, properties, received)
+        # Respondió (aunque sea tarde): el circuito de la instancia se cierra
+        circuit_breakers.record_success(microservice_id)
+
+        # Sin entrada: respuesta tardía, se cuenta y no se guarda
+        pending = pending_store.get(request_id)
+        total = 1
+        if pending is None:
+            live_metrics.LATE_RESPONSES.inc()
+            observe_late_response(microservice_id, response_data, properties, received)
+        else:
+            # Se cuenta una sola vez al llegar y despierta al hilo si terminó
+            total = pending.add(
+                {"microservice_id": microservice_id, "response": response_data}
+            )
+            latency = pending.latency(microservice_id)
+            live_metrics.MICROSERVICE_LATENCY.labels(str(microservice_id)).observe(
+                latency
+            )
+            if isinstance(pending.tally, VoteTally):
+                # Solo consultas simples: los lotes no son comparables
+                hedge_policy.tracker.observe(latency)
+                deadline_policy.observe(microservice_id, latency)
+
+        log_response(
+            request_id,
+            microservice_id,
+            response_data,
+            total,
+            pending.start_time if pending is not None else None,
+        )
+
+        return ACK
+    except (json.JSONDecodeError, message_codec.DecodeError) as e:
+        log_metric(
+            "response_error",
+            status=(
+                "json_decode_error"
+                if isinstance(e, json.JSONDecodeError)
+                else "decode_error"
+            ),
+            extra_info=str(e),
+            microservice_id="-",
+            failed_microservices=[],
+        )
+        return REJECT
+    except Exception as e:
+        log_metric(
+            "response_error",
+            status="processing_error",
+            extra_info=str(e),
+            microservice_id="-",
+            failed_microservices=[],
+        )
+        return REQUEUE
+    finally:
+        live_metrics.CONSUME_TIME.observe(time.perf_counter() - started)
+
+
+def request_timeout(header_value):
+    """Espera máxima de la request: MAX_WAIT_TIME, o menos si el cliente
+    mandó DEADLINE_HEADER; ValueError si no es un número positivo"""
+    if header_value is None:
+        return MAX_WAIT_TIME
+    timeout = float(header_value) / 1000.0
+    if not timeout > 0:
+        raise ValueError(f"{DEADLINE_HEADER} must be a positive number")
+    return min(timeout, MAX_WAIT_TIME)
+
+
+def coalescing_key(data, timeout):
+    """Solo se agrupan consultas iguales con la misma espera máxima"""
+    key = request_key(data)
+    return key if timeout == MAX_WAIT_TIME else f"{key}|{timeout}"
+
+
+def skip_open_circuits(request_id, pending, target_microservices):
+    """Instancias a consultar; las de circuito abierto no se esperan"""
+    allowed, skipped = circuit_breakers.available(target_microservices)
+    if skipped:
+        pending.exclude(skipped)
+        for microservice_id in skipped:
+            live_metrics.CIRCUIT_SKIPS.labels(str(microservice_id)).inc()
+        log_metric(
+            "circuit_open",
+            request_id=request_id,
+            status="skipped",
+            extra_info=f"not dispatching to {skipped}",
+            microservice_id="-",
+            failed_microservices=skipped,
+        )
+    return allowed
+
+
+def observe_late_response(microservice_id, response_data, properties, received):
+    """Latencia de una respuesta tardía (request ya terminada) según su marca
+    de publicación. Sin esto la ventana de deadlines solo vería respuestas
+    por debajo del deadline vigente y nunca podría volver a crecer."""
+    headers = getattr(properties, "headers", None) or {}
+    published = headers.get(TS_VALIDADOR_PUBLISH)
+    data = response_data.get("data") if isinstance(response_data, dict) else None
+    if published is None or (isinstance(data, dict) and "items" in data):
+        # Sin marca, o respuesta de lote: no es comparable
+        return
+    deadline_policy.observe(microservice_id, received - published / 1_000_000)
+
+
+def finish_waiting(request_id, pending):
+    """Alimentar los circuitos con los deadlines vencidos de la request"""
+    tally = pending.tally
+    if pending.expired:
+        circuit_breakers.record_failures(pending.expired)
+        if isinstance(tally, VoteTally):
+            # Un deadline vencido cuenta como una muestra en el deadline: si
+            # las latencias suben, el percentil sube con ellas
+            for microservice_id in pending.expired:
+                deadline_policy.observe(
+                    microservice_id,
+                    pending.deadlines[microservice_id]
+                    - pending.sent_at[microservice_id],
+                )
+        log_metric(
+            "instance_deadline",
+            request_id=request_id,
+            status="expired",
+            extra_info=f"stopped waiting for {pending.expired}",
+            microservice_id="-",
+            failed_microservices=pending.expired,
+        )
+    if not isinstance(tally, VoteTally) or not tally.impossible:
+        return
+    # Sin nadie pendiente ni excluido es un desacuerdo con todas las
+    # respuestas: la votación no terminó antes de tiempo
+    outstanding = [ms for ms in tally.dispatched if ms not in tally.responded]
+    if outstanding or tally.excluded:
+        live_metrics.EARLY_EXITS.inc()
+        log_metric(
+            "quorum_impossible",
+            request_id=request_id,
+            status="early_exit",
+            extra_info=f"responded={sorted(tally.responded)}, excluded={sorted(tally.excluded)}",
+            microservice_id="-",
+            failed_microservices=sorted(tally.excluded),
+        )
+
+
+def publish_failed(request_id, pending, microservice_id, reason):
+    """Nack o return del broker: esa instancia no va a responder"""
+    pending.undeliverable(microservice_id)
+    live_metrics.PUBLISH_FAILURES.labels(str(microservice_id), reason).inc()
+    log_metric(
+        "publish_confirm",
+        request_id=request_id,
+        status=reason,
+        extra_info=f"stopped waiting for microservice {microservice_id}",
+        microservice_id=microservice_id,
+        failed_microservices=[microservice_id],
+    )
+
+
+def fanout_confirms(request_id, pending, target_microservices):
+    """Seguimiento en lote de los confirms de un fan-out, o None sin confirms"""
+    if not PUBLISHER_CONFIRMS or pending is None:
+        return None
+    return FanoutConfirms(
+        target_microservices,
+        on_failure=lambda ms, reason: publish_failed(request_id, pending, ms, reason),
+        on_complete=lambda fanout: live_metrics.CONFIRM_TIME.observe(
+            time.perf_counter() - fanout.started
+        ),
+    )
+
+
+def batch_result(
+    request_id,
+    product_ids,
+    decided,
+    target_microservices,
+    request_responses,
+    final_wait_time,
+):
+    """Registrar la votación por producto y devolver (cuerpo, status)"""
+    responded_services = set(r["microservice_id"] for r in request_responses)
+    failed_microservices = list(set(target_microservices) - responded_services)
+    no_consensus = [p for p in product_ids if p not in decided]
+
+    if not no_consensus:
+        status = "consensus_reached"
+    elif decided:
+        status = "partial_consensus"
+    else:
+        status = "no_consensus"
+    live_metrics.VOTE_OUTCOMES.labels(status).inc()
+    count_timeouts(failed_microservices)
+    log_metric(
+        "vote_result",
+        request_id=request_id,
+        status=status,
+        extra_info=f"decided={len(decided)}/{len(product_ids)}",
+        microservice_id="-",
+        failed_microservices=failed_microservices,
+    )
+    log_metric(
+        "latency_summary",
+        request_id=request_id,
+        status="success" if not no_consensus else "failed",
+        extra_info=f"responses={len(request_responses)}, total_time={final_wait_time:.2f}s",
+        microservice_id="-",
+        failed_microservices=[],
+    )
+
+    body = {
+        "request_id": request_id,
+        "results": decided,
+        "wait_time": f"{final_wait_time:.2f}s",
+    }
+    if not no_consensus:
+        return body, 200
+
+    body.update(
+        {
+            "error": "No se obtuvo consenso para todos los productos.",
+            "no_consensus": no_consensus,
+            "failed_microservices": failed_microservices,
+        }
+    )
+    return body, 500
+
+
+def determine_target_microservices(data):
+    if "product_id" in data or "product_ids" in data:
+        return [1, 2, 3]
+    elif "category" in data:
+        return [1, 2]
+    else:
+        return [1]
+
+
+def request_message(request_id, data):
+    return message_codec.encode_request(request_id, data, MESSAGE_CONTENT_TYPE)
+
+
+# Marcas de tiempo por etapa que viajan como headers AMQP, en microsegundos
+# epoch enteros (pika no codifica floats en una tabla de headers): el
+# validador marca la publicación, el inventario agrega las suyas y las
+# devuelve en la respuesta, y al recibirla se calculan los tramos.
+# Son relojes de equipos distintos: entre hosts el tramo de cola incluye el
+# desfase entre relojes
+TS_VALIDADOR_PUBLISH = "x-ts-validador-publish"
+TS_INVENTARIO_DEQUEUE = "x-ts-inventario-dequeue"
+TS_INVENTARIO_START = "x-ts-inventario-start"
+TS_DB_START = "x-ts-db-start"
+TS_DB_END = "x-ts-db-end"
+TS_RESPONSE_PUBLISH = "x-ts-response-publish"
+TS_VALIDADOR_RECEIVE = "x-ts-validador-receive"
+
+# (tramo, marca inicial, marca final), en el orden del recorrido
+STAGE_SPANS = [
+    ("request_queue", TS_VALIDADOR_PUBLISH, TS_INVENTARIO_DEQUEUE),
+    ("worker_wait", TS_INVENTARIO_DEQUEUE, TS_INVENTARIO_START),
+    ("processing", TS_INVENTARIO_START, TS_DB_START),
+    ("db", TS_DB_START, TS_DB_END),
+    ("respond", TS_DB_END, TS_RESPONSE_PUBLISH),
+    ("response_queue", TS_RESPONSE_PUBLISH, TS_VALIDADOR_RECEIVE),
+    ("total", TS_VALIDADOR_PUBLISH, TS_VALIDADOR_RECEIVE),
+]
+
+
+def stamp(t):
+    """Marca x-ts-* para un header: epoch `t` (segundos) en microsegundos"""
+    return int(t * 1_000_000)
+
+
+def stage_spans(properties, received):
+    """Tramos en ms según los headers de la respuesta; {} si no trae marcas"""
+    stamps = dict(getattr(properties, "headers", None) or {})
+    stamps[TS_VALIDADOR_RECEIVE] = stamp(received)
+    spans = {}
+    for name, start, end in STAGE_SPANS:
+        if start in stamps and end in stamps:
+            spans[name] = round((stamps[end] - stamps[start]) / 1000.0, 3)
+    return spans if len(spans) > 1 else {}
+
+
+def log_stage_spans(request_id, microservice_id, properties, received):
+    spans = stage_spans(properties, received)
+    if not spans:
+        return
+    for name, value in spans.items():
+        live_metrics.STAGE_TIME.labels(name, str(microservice_id)).observe(
+            value / 1000.0
+        )
+    log_metric(
+        "stage_timing",
+        request_id=request_id,
+        status="measured",
+        extra_info=spans,
+        microservice_id=microservice_id,
+        failed_microservices=[],
+    )
+
+
+def request_properties(request_id, deadline=None):
+    """Propiedades de una request; con deadline (epoch) se agrega el header
+    y un TTL por mensaje, así el broker la descarta si vence en la cola"""
+    now = time.time()
+    headers = {TS_VALIDADOR_PUBLISH: stamp(now)}
+    expiration = None
+    if deadline is not None:
+        headers[REQUEST_DEADLINE_HEADER] = int(deadline * 1000)
+        expiration = str(max(int((deadline - now) * 1000), 0))
+    return pika.BasicProperties(
+        delivery_mode=DELIVERY_MODE,
+        content_type=MESSAGE_CONTENT_TYPE,
+        correlation_id=request_id,
+        reply_to=get_reply_queue(),
+        expiration=expiration,
+        headers=headers,
+    )
+
+
+def send_to_rabbitmq(
+    transport, request_id, target_microservices, data, deadline=None, pending=None
+):
+    """Publicar la request a cada instancia por `transport` sin esperar
+    confirms; con `pending`, un nack o return deja de esperar a esa instancia"""
+    try:
+        body = request_message(request_id, data)
+        fanout = fanout_confirms(request_id, pending, target_microservices)
+        for microservice_id in target_microservices:
+            send_time = time.time()
+            transport.publish(
+                routing_key=f"microservice_{microservice_id}",
+                body=body,
+                properties=request_properties(request_id, deadline),
+                confirm=fanout.target(microservice_id) if fanout else None,
+            )
+            log_metric(
+                "send_to_rabbitmq",
+                request_id=request_id,
+                status="sent",
+                extra_info=f"to microservice {microservice_id}, send_time={send_time}",
+                microservice_id=microservice_id,
+                failed_microservices=[],
+            )
+
+        log_metric(
+            "send_batch_complete",
+            request_id=request_id,
+            status="done",
+            extra_info=f"sent {len(target_microservices)} messages",
+            microservice_id="-",
+            failed_microservices=[],
+        )
+    except Exception as e:
+        log_metric(
+            "send_to_rabbitmq",
+            request_id=request_id,
+            status="error",
+            extra_info=str(e),
+            microservice_id="-",
+            failed_microservices=[],
+        )
+        raise
+
+
+def send_hedge(
+    transport, request_id, pending, primary, reserve, budget, data, deadline
+):
+    """Consultar la instancia de reserva: las iniciales discreparon o alguna
+    no respondió dentro del presupuesto de latencia"""
+    if len(pending.responses()) >= len(primary):
+        reason = "disagreement"
+    else:
+        reason = "latency_budget"
+    log_metric(
+        "hedge_dispatch",
+        request_id=request_id,
+        status=reason,
+        extra_info=f"to {reserve}, budget={budget:.3f}s",
+        microservice_id="-",
+        failed_microservices=[],
+    )
+    pending.dispatch(reserve)
+    send_to_rabbitmq(transport, request_id, reserve, data, deadline, pending)
+
+
+class InvalidRequest(ValueError):
+    """Consulta rechazada con 400; el mensaje va como "error" en el cuerpo"""
+
+
+def reject_request(event, error, detail=None):
+    log_metric(
+        event,
+        status="failed",
+        extra_info=detail or error,
+        microservice_id="-",
+        failed_microservices=[],
+    )
+    raise InvalidRequest(error)
+
+
+def checked_timeout(event, header_value):
+    try:
+        return request_timeout(header_value)
+    except ValueError as e:
+        reject_request(event, f"Invalid {DEADLINE_HEADER} header", str(e))
+
+
+def check_request(data, header_value):
+    """Espera máxima de una consulta a /process; InvalidRequest si no sirve"""
+    if not data:
+        reject_request("process_request", "No JSON data provided")
+    return checked_timeout("process_request", header_value)
+
+
+def check_batch_request(data, header_value):
+    """(product_ids sin repetir, espera máxima) de una consulta a
+    /process/batch; InvalidRequest si no sirve"""
+    product_ids = data.get("product_ids") if data else None
+    if not isinstance(product_ids, list) or not product_ids:
+        reject_request("process_batch_request", "product_ids must be a non-empty list")
+    if len(product_ids) > MAX_BATCH_SIZE:
+        reject_request(
+            "process_batch_request",
+            f"At most {MAX_BATCH_SIZE} product_ids per batch",
+            f"batch of {len(product_ids)} exceeds {MAX_BATCH_SIZE}",
+        )
+    timeout = checked_timeout("process_batch_request", header_value)
+    return list(dict.fromkeys(str(p) for p in product_ids)), timeout
+
+
+def log_coalesced(body, source):
+    if source != "leader":
+        log_metric(
+            "request_coalesced",
+            request_id=body.get("request_id", "-"),
+            status=source,
+            microservice_id="-",
+            failed_microservices=[],
+        )
+
+
+def consensus_steps(transport, pending_class, data, timeout=MAX_WAIT_TIME):
+    """Fan-out y votación de una consulta.
+
+    Es un generador: cada vez que hay que esperar la votación produce
+    (pending, deadline) y al terminar devuelve (cuerpo, status). Quien lo
+    recorre espera a su manera, con run_steps o run_steps_async.
+    """
+    request_id = new_request_id()
+    target_microservices = determine_target_microservices(data)
+    # Registrar antes de publicar para no perder respuestas rápidas
+    pending = pending_class(
+        VoteTally(target_microservices, quorum_strategy, dispatched=[]),
+        budget=deadline_policy.budget,
+    )
+    pending_store.register(request_id, pending, pending.start_time + timeout)
+    log_metric(
+        "request_start",
+        request_id=request_id,
+        status="received",
+        microservice_id="-",
+        failed_microservices=[],
+    )
+
+    try:
+        available = skip_open_circuits(request_id, pending, target_microservices)
+        primary, reserve = hedge_policy.split(available)
+        deadline = pending.start_time + timeout
+        pending.dispatch(primary)
+        send_to_rabbitmq(transport, request_id, primary, data, deadline, pending)
+
+        start_time = time.time()
+
+        log_metric(
+            "process_request",
+            request_id=request_id,
+            status="waiting_responses",
+            extra_info=f"expecting {len(primary)}",
+            microservice_id="-",
+            failed_microservices=[],
+        )
+
+        if reserve:
+            budget = hedge_policy.tracker.budget()
+            yield pending, min(start_time + budget, deadline)
+            if pending.tally.decision is None and not pending.tally.impossible:
+                send_hedge(
+                    transport,
+                    request_id,
+                    pending,
+                    primary,
+                    reserve,
+                    budget,
+                    data,
+                    deadline,
+                )
+
+        # El consumidor despierta al terminar la votación
+        yield pending, deadline
+    finally:
+        pending_store.remove(request_id)
+    finish_waiting(request_id, pending)
+
+    request_responses = pending.responses()
+    valid_response = pending.tally.decision
+    final_wait_time = time.time() - start_time
+    if valid_response is not None:
+        body, status_code = consensus_result(
+            request_id, valid_response, request_responses, final_wait_time
+        )
+    else:
+        body, status_code = no_consensus_result(
+            request_id, pending.tally.dispatched, request_responses, final_wait_time
+        )
+    return body, status_code
+
+
+def batch_steps(transport, pending_class, data, product_ids, timeout=MAX_WAIT_TIME):
+    """Como consensus_steps, para muchos product_id con un solo mensaje por
+    instancia (product_ids ya validados por check_batch_request)"""
+    request_id = new_request_id()
+    batch_data = dict(data, product_ids=product_ids)
+    target_microservices = determine_target_microservices(batch_data)
+    # Registrar antes de publicar para no perder respuestas rápidas. Los
+    # lotes esperan MAX_WAIT_TIME por instancia: sus latencias no se
+    # comparan con las de consultas simples
+    pending = pending_class(
+        BatchVoteTally(
+            product_ids, target_microservices, quorum_strategy, dispatched=[]
+        )
+    )
+    pending_store.register(request_id, pending, pending.start_time + timeout)
+    log_metric(
+        "request_start",
+        request_id=request_id,
+        status="received",
+        extra_info=f"batch of {len(product_ids)} products",
+        microservice_id="-",
+        failed_microservices=[],
+    )
+
+    try:
+        available = skip_open_circuits(request_id, pending, target_microservices)
+        pending.dispatch(available)
+        send_to_rabbitmq(
+            transport,
+            request_id,
+            available,
+            batch_data,
+            pending.start_time + timeout,
+            pending,
+        )
+        start_time = time.time()
+        yield pending, pending.start_time + timeout
+    finally:
+        pending_store.remove(request_id)
+    finish_waiting(request_id, pending)
+
+    return batch_result(
+        request_id,
+        product_ids,
+        pending.decided(),
+        available,
+        pending.responses(),
+        time.time() - start_time,
+    )
+
+
+def run_steps(steps):
+    """Recorrer consensus_steps o batch_steps bloqueando este hilo"""
+    try:
+        while True:
+            pending, deadline = next(steps)
+            pending.wait_until(deadline)
+    except StopIteration as done:
+        return done.value
+    finally:
+        # Si la espera falla, el finally del generador quita la entrada
+        steps.close()
+
+
+async def run_steps_async(steps):
+    """Como run_steps, esperando en el event loop"""
+    try:
+        while True:
+            pending, deadline = next(steps)
+            await pending.wait_until(deadline)
+    except StopIteration as done:
+        return done.value
+    finally:
+        steps.close()
+
+
+def health_status(single_flight):
+    log_metric(
+        "health_check", status="ok", microservice_id="-", failed_microservices=[]
+    )
+    return {
+        "status": "healthy",
+        "service": "validador",
+        "timestamp": time.time(),
+        "query_cache": single_flight.stats(),
+        "pending_requests": pending_store.stats(),
+        "circuit_breakers": circuit_breakers.stats(),
+        "deadlines": deadline_policy.stats(),
+    }
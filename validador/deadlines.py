@@ -0,0 +1,87 @@
+import os
+import threading
+
+from hedging import LatencyTracker
+
+
+class DeadlinePolicy:
+    """Cuánto esperar a cada microservicio según sus latencias observadas.
+
+    Cada instancia tiene su propia ventana de latencias; su deadline es
+    `multiplier` veces el percentil `percentile`, acotado entre `floor` y
+    `max_wait`. Una instancia sin `min_samples` propias (p. ej. caída desde
+    el arranque) usa la ventana conjunta de todas; si tampoco alcanza, o con
+    enabled=False, se espera `max_wait` como antes.
+
+    El validador también observa las respuestas que llegan después de
+    terminada la request y cuenta cada deadline vencido como una muestra en
+    el deadline, para que la ventana pueda crecer si la instancia se vuelve
+    más lenta.
+    """
+
+    def __init__(
+        self,
+        max_wait,
+        enabled=True,
+        percentile=99,
+        multiplier=2.0,
+        floor=0.25,
+        window=500,
+        min_samples=20,
+    ):
+        self.max_wait = max_wait
+        self.enabled = enabled
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.floor = floor
+        self.window = window
+        self.min_samples = min_samples
+        self._trackers = {}
+        self._pooled = self._new_tracker()
+        self._lock = threading.Lock()
+
+    def _new_tracker(self):
+        return LatencyTracker(
+            window=self.window,
+            percentile=self.percentile,
+            min_samples=self.min_samples,
+            default_budget=None,
+        )
+
+    def observe(self, microservice_id, latency):
+        tracker = self._trackers.get(microservice_id)
+        if tracker is None:
+            with self._lock:
+                tracker = self._trackers.setdefault(
+                    microservice_id, self._new_tracker()
+                )
+        tracker.observe(latency)
+        self._pooled.observe(latency)
+
+    def budget(self, microservice_id):
+        """Segundos a esperar la respuesta de esta instancia"""
+        if not self.enabled:
+            return self.max_wait
+        tracker = self._trackers.get(microservice_id)
+        estimate = tracker.budget() if tracker is not None else None
+        if estimate is None:
+            estimate = self._pooled.budget()
+        if estimate is None:
+            return self.max_wait
+        return min(self.max_wait, max(self.floor, estimate * self.multiplier))
+
+    def stats(self):
+        return {str(ms): round(self.budget(ms), 3) for ms in sorted(self._trackers)}
+
+
+def deadline_policy_from_env(max_wait):
+    """ADAPTIVE_DEADLINES=0 vuelve a esperar siempre max_wait por instancia"""
+    return DeadlinePolicy(
+        max_wait,
+        enabled=os.getenv("ADAPTIVE_DEADLINES", "1") == "1",
+        percentile=float(os.getenv("DEADLINE_PERCENTILE", "99")),
+        multiplier=float(os.getenv("DEADLINE_MULTIPLIER", "2")),
+        floor=float(os.getenv("DEADLINE_MIN", "0.25")),
+        window=int(os.getenv("DEADLINE_WINDOW", "500")),
+        min_samples=int(os.getenv("DEADLINE_MIN_SAMPLES", "20")),
+    )
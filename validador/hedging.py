@@ -0,0 +1,74 @@
+import itertools
+import os
+import threading
+from collections import deque
+
+
+class LatencyTracker:
+    """Ventana móvil de latencias de respuesta (envío -> respuesta).
+
+    El presupuesto de espera antes de cubrir con la instancia de reserva es
+    el percentil `percentile` de lo observado; hasta juntar `min_samples`
+    se usa `default_budget`.
+    """
+
+    def __init__(self, window=500, percentile=95, min_samples=20, default_budget=2.0):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.default_budget = default_budget
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, latency):
+        with self._lock:
+            self._samples.append(latency)
+
+    def budget(self):
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < self.min_samples:
+            return self.default_budget
+        index = min(len(samples) - 1, int(len(samples) * self.percentile / 100))
+        return samples[index]
+
+
+class HedgePolicy:
+    """Decide a qué instancias enviar primero y cuál queda de reserva.
+
+    Solo se cubre cuando las instancias iniciales pueden alcanzar el quorum
+    por sí solas; la reserva rota entre requests para repartir la carga.
+    """
+
+    def __init__(self, strategy, enabled=False, tracker=None):
+        self.strategy = strategy
+        self.enabled = enabled
+        self.tracker = tracker or LatencyTracker()
+        self._rotation = itertools.count()
+
+    def split(self, targets):
+        """(iniciales, reserva) para una lista de microservicios"""
+        targets = list(targets)
+        if not self.enabled or len(targets) < 3:
+            return targets, []
+        offset = next(self._rotation)
+        for i in range(len(targets)):
+            reserve = targets[(offset + i) % len(targets)]
+            primary = [ms for ms in targets if ms != reserve]
+            weight = sum(self.strategy.weight(ms) for ms in primary)
+            if self.strategy.reached(weight, targets):
+                return primary, [reserve]
+        return targets, []
+
+
+def hedge_policy_from_env(strategy):
+    """HEDGED_DISPATCH=1 activa el envío a dos instancias y luego a la tercera"""
+    return HedgePolicy(
+        strategy,
+        enabled=os.getenv("HEDGED_DISPATCH", "0") == "1",
+        tracker=LatencyTracker(
+            window=int(os.getenv("HEDGE_WINDOW", "500")),
+            percentile=float(os.getenv("HEDGE_PERCENTILE", "95")),
+            min_samples=int(os.getenv("HEDGE_MIN_SAMPLES", "20")),
+            default_budget=float(os.getenv("HEDGE_DEFAULT_BUDGET", "2.0")),
+        ),
+    )
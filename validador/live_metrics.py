@@ -0,0 +1,136 @@
+"""Métricas en memoria del validador, expuestas en /metrics (formato Prometheus).
+
+Son contadores e histogramas de buckets fijos: observar es sumar en un
+bucket, sin E/S. metrics.csv sigue siendo el registro detallado por evento
+para analisis.py; esto es para ver regresiones mientras ocurren.
+"""
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+
+# Latencias de punta a punta: de 1 ms hasta el MAX_WAIT_TIME (8 s)
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.0,
+    4.0,
+    8.0,
+    16.0,
+)
+
+# Operaciones locales (publicar, procesar un mensaje): de 10 µs a 100 ms
+FAST_BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.1,
+)
+
+# Registro propio: el validador no comparte el global de prometheus_client
+registry = CollectorRegistry()
+
+REQUEST_LATENCY = Histogram(
+    "validador_request_latency_seconds",
+    "Latencia de las requests HTTP de consulta",
+    ["endpoint", "status"],
+    buckets=LATENCY_BUCKETS,
+    registry=registry,
+)
+MICROSERVICE_LATENCY = Histogram(
+    "validador_microservice_response_seconds",
+    "Tiempo desde el envío hasta la respuesta de cada microservicio",
+    ["microservice"],
+    buckets=LATENCY_BUCKETS,
+    registry=registry,
+)
+VOTE_OUTCOMES = Counter(
+    "validador_vote_outcomes_total",
+    "Resultados de la votación",
+    ["outcome"],
+    registry=registry,
+)
+TIMEOUTS = Counter(
+    "validador_microservice_timeouts_total",
+    "Microservicios consultados que no respondieron a tiempo",
+    ["microservice"],
+    registry=registry,
+)
+LATE_RESPONSES = Counter(
+    "validador_late_responses_total",
+    "Respuestas recibidas sin request pendiente (tardías)",
+    registry=registry,
+)
+PUBLISH_TIME = Histogram(
+    "validador_publish_seconds",
+    "Tiempo de basic_publish de una request en el canal AMQP",
+    buckets=FAST_BUCKETS,
+    registry=registry,
+)
+CONFIRM_TIME = Histogram(
+    "validador_publish_confirm_seconds",
+    "Desde el fan-out hasta que el broker confirmó todos sus mensajes",
+    buckets=LATENCY_BUCKETS,
+    registry=registry,
+)
+PUBLISH_FAILURES = Counter(
+    "validador_publish_failures_total",
+    "Requests no entregadas: nacked, returned, channel_closed o unpublishable",
+    ["microservice", "reason"],
+    registry=registry,
+)
+CONSUME_TIME = Histogram(
+    "validador_consume_seconds",
+    "Tiempo de procesar una respuesta en el consumidor",
+    buckets=FAST_BUCKETS,
+    registry=registry,
+)
+STAGE_TIME = Histogram(
+    "validador_stage_seconds",
+    "Duración de cada tramo de una consulta según los headers x-ts-*",
+    ["stage", "microservice"],
+    buckets=FAST_BUCKETS + (0.25, 0.5, 1.0, 2.0, 4.0, 8.0),
+    registry=registry,
+)
+CIRCUIT_SKIPS = Counter(
+    "validador_circuit_skips_total",
+    "Envíos omitidos porque el circuito de la instancia estaba abierto",
+    ["microservice"],
+    registry=registry,
+)
+EARLY_EXITS = Counter(
+    "validador_quorum_impossible_total",
+    "Requests terminadas antes del timeout porque el quorum ya era imposible",
+    registry=registry,
+)
+PENDING_REQUESTS = Gauge(
+    "validador_pending_requests",
+    "Requests esperando respuestas",
+    registry=registry,
+)
+
+
+def render():
+    """(cuerpo, content_type) para la respuesta de /metrics"""
+    return generate_latest(registry), CONTENT_TYPE_LATEST
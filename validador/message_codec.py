@@ -0,0 +1,61 @@
+"""Codificación de los mensajes validador <-> inventario según content_type.
+
+JSON (application/json) es el formato original y el de respaldo:
+    request:  {"request_id", "data"}
+    response: {"request_id", "microservice_id", "response": {...}}
+
+msgpack (application/x-msgpack) usa un sobre plano y el request_id viaja
+solo como correlation_id:
+    request:  data
+    response: {"microservice_id", "status", "processing_time", "data"}
+
+El inventario responde con el mismo content_type que recibió.
+"""
+
+import json
+import os
+
+try:
+    import msgpack
+except ImportError:  # Sin msgpack solo se habla JSON
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/x-msgpack"
+
+
+class DecodeError(ValueError):
+    """Cuerpo que no se puede decodificar con su content_type"""
+
+
+def content_type_from_env():
+    """MESSAGE_ENCODING=msgpack (por defecto) o json; sin msgpack, json"""
+    if os.getenv("MESSAGE_ENCODING", "msgpack") == "msgpack" and msgpack is not None:
+        return MSGPACK
+    return JSON
+
+
+def encode_request(request_id, data, content_type):
+    if content_type == MSGPACK:
+        return msgpack.packb(data)
+    return json.dumps({"request_id": request_id, "data": data})
+
+
+def decode_response(body, properties=None):
+    """(request_id, microservice_id, response) de un mensaje de inventario"""
+    correlation_id = getattr(properties, "correlation_id", None)
+    if getattr(properties, "content_type", None) == MSGPACK:
+        if msgpack is None:
+            raise DecodeError("msgpack is not installed")
+        try:
+            response = msgpack.unpackb(body)
+            microservice_id = response["microservice_id"]
+        except Exception as e:
+            raise DecodeError(str(e)) from e
+        # El cuerpo de la respuesta conserva la forma que ve el cliente
+        response["request_id"] = correlation_id
+        return str(correlation_id), microservice_id, response
+
+    data = json.loads(body)
+    request_id = correlation_id or data["request_id"]
+    return str(request_id), data["microservice_id"], data["response"]
@@ -0,0 +1,431 @@
+import csv
+import json
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+
+METRICS_COLUMNS = [
+    "timestamp",
+    "event",
+    "request_id",
+    "status",
+    "extra_info",
+    "microservice_id",
+    "failed_microservices",
+    "proc_id",
+    "thread_id",
+]
+
+
+def format_row(row):
+    """Convertir un evento crudo en la fila de texto del CSV"""
+    (
+        timestamp,
+        event,
+        request_id,
+        status,
+        extra_info,
+        microservice_id,
+        failed_microservices,
+        proc_id,
+        thread_id,
+    ) = row
+
+    # Asegurarse que extra_info sea string
+    if not isinstance(extra_info, str):
+        try:
+            extra_info = json.dumps(extra_info, ensure_ascii=False)
+        except Exception:
+            extra_info = str(extra_info)
+
+    # Serializar lista de microservicios fallidos
+    failed_str = "-"
+    if failed_microservices is not None:
+        try:
+            failed_str = json.dumps(failed_microservices, ensure_ascii=False)
+        except Exception:
+            failed_str = str(failed_microservices)
+
+    return [
+        timestamp,
+        event,
+        request_id,
+        status,
+        extra_info,
+        microservice_id,
+        failed_str,
+        proc_id,
+        thread_id,
+    ]
+
+
+# --- Formato binario columnar ---
+#
+# Cada segmento (metrics_segments/segment-000001.bin, ...) es una secuencia
+# de bloques que solo se agregan al final; cada bloque es un lote del writer:
+#
+#   "MTB2" | n_rows u32 | proc_id u32 | n_strings u16
+#   tabla de strings internados: (len u16 + utf-8) * n_strings
+#   n_cols u8 | directorio: (nombre len u8 + utf-8, tipo u8, nbytes u32) * n_cols
+#   payload de cada columna en el mismo orden del directorio, comprimido
+#   con zlib (nbytes es el tamaño comprimido)
+#
+# Tipos: "d" float64, "q" int64, "H" índice u16 a la tabla de strings,
+# "u" uuid en 16 bytes por fila (ceros = "-"), "s" strings (offsets u32 *
+# (n_rows + 1) + bytes utf-8). Todo little-endian. El proc_id va una sola
+# vez por bloque; event, status y failed_microservices se internan. Cada
+# columna se comprime por separado, así el lector (analisis.py) sigue
+# saltando columnas enteras; también lee los bloques "MTB1", sin comprimir.
+SEGMENT_MAGIC = b"MTB2"
+SEGMENT_COMPRESSION_LEVEL = 6
+
+# Columna -> tipo de almacenamiento (proc_id va en la cabecera del bloque)
+SEGMENT_COLUMNS = [
+    ("timestamp", "d"),
+    ("event", "H"),
+    ("request_id", "u"),
+    ("status", "H"),
+    ("extra_info", "s"),
+    ("microservice_id", "q"),
+    ("failed_microservices", "H"),
+    ("thread_id", "q"),
+]
+
+
+def _little_endian(values):
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values.tobytes()
+
+
+class SegmentWriter:
+    """Escritor append-only del formato binario columnar de métricas
+
+    Los lotes del writer se juntan hasta `block_rows` filas (o hasta que la
+    más vieja tiene `block_interval` segundos) antes de escribir un bloque:
+    con bloques chicos la cabecera y la compresión no rinden. Lo pendiente
+    se escribe al cerrar.
+    """
+
+    def __init__(
+        self,
+        directory,
+        max_segment_bytes=64 * 1024 * 1024,
+        block_rows=4096,
+        block_interval=5.0,
+    ):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.block_rows = block_rows
+        self.block_interval = block_interval
+        self._file = None
+        self._segment = 0
+        self._pending = []
+        self._pending_since = None
+
+    def write_batch(self, rows):
+        """Agregar filas; con rows vacío solo escribe el bloque si venció"""
+        if rows:
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending.extend(rows)
+        if not self._pending:
+            return
+        if (
+            len(self._pending) >= self.block_rows
+            or time.monotonic() - self._pending_since >= self.block_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        rows, self._pending = self._pending, []
+        if not rows:
+            return
+        if self._file is None:
+            self._open_next_segment()
+        self._file.write(self._encode_block(rows))
+        self._file.flush()
+        if self._file.tell() >= self.max_segment_bytes:
+            self._close_file()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._close_file()
+
+    def _close_file(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            finally:
+                self._file = None
+
+    def _open_next_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # Nunca reabrir un segmento existente: cada proceso sigue la numeración
+        existing = [
+            int(name[8:14])
+            for name in os.listdir(self.directory)
+            if name.startswith("segment-") and name.endswith(".bin")
+        ]
+        self._segment = max(existing + [self._segment]) + 1
+        path = os.path.join(self.directory, f"segment-{self._segment:06d}.bin")
+        self._file = open(path, "ab")
+
+    def _encode_block(self, rows):
+        strings = {}
+
+        def intern(value):
+            value = str(value)
+            index = strings.get(value)
+            if index is None:
+                index = strings[value] = len(strings)
+            return index
+
+        def encode_strings(values):
+            offsets = array("I", [0])
+            data = bytearray()
+            for value in values:
+                data += str(value).encode("utf-8")
+                offsets.append(len(data))
+            return _little_endian(offsets) + bytes(data)
+
+        def encode_uuids(values):
+            # request_id es uuid4().hex; si algún valor del bloque no lo es,
+            # la columna de ese bloque se guarda como strings
+            data = bytearray()
+            for value in values:
+                if value == "-":
+                    data += bytes(16)
+                    continue
+                try:
+                    raw = bytes.fromhex(value)
+                except (TypeError, ValueError):
+                    return None
+                if raw.hex() != value or len(raw) != 16:
+                    return None
+                data += raw
+            return bytes(data)
+
+        def to_int(value):
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                return -1
+
+        formatted = [format_row(row) for row in rows]
+        columns = list(zip(*formatted))
+        by_name = dict(zip(METRICS_COLUMNS, columns))
+
+        payloads = []
+        for name, kind in SEGMENT_COLUMNS:
+            values = by_name[name]
+            if kind == "d":
+                payload = _little_endian(array("d", (float(v) for v in values)))
+            elif kind == "q":
+                payload = _little_endian(array("q", (to_int(v) for v in values)))
+            elif kind == "H":
+                payload = _little_endian(array("H", (intern(v) for v in values)))
+            elif kind == "u":
+                payload = encode_uuids(values)
+                if payload is None:
+                    kind = "s"
+                    payload = encode_strings(values)
+            else:
+                payload = encode_strings(values)
+            payload = zlib.compress(payload, SEGMENT_COMPRESSION_LEVEL)
+            payloads.append((name, kind, payload))
+
+        header = bytearray(SEGMENT_MAGIC)
+        header += struct.pack("<IIH", len(rows), os.getpid(), len(strings))
+        for value in strings:
+            encoded = value.encode("utf-8")
+            header += struct.pack("<H", len(encoded)) + encoded
+        header += struct.pack("<B", len(payloads))
+        for name, kind, payload in payloads:
+            encoded = name.encode("utf-8")
+            header += struct.pack("<B", len(encoded)) + encoded
+            header += struct.pack("<cI", kind.encode("ascii"), len(payload))
+        return bytes(header) + b"".join(payload for _, _, payload in payloads)
+
+
+class MetricsWriter:
+    """Sumidero asíncrono de métricas.
+
+    Los hilos de la aplicación solo hacen put_nowait en una cola acotada;
+    un hilo de fondo serializa y escribe las filas por lotes. Si la cola se
+    llena el evento se descarta y se cuenta, y el total de descartes queda
+    registrado en el propio log como evento "metrics_dropped". Con max_bytes
+    > 0 el archivo rota al superar ese tamaño (metrics.csv.1, .2, ...).
+    Con path=None no se escribe CSV; segment_writer agrega el formato binario.
+    """
+
+    def __init__(
+        self,
+        path,
+        max_queue=100000,
+        batch_size=500,
+        flush_interval=0.5,
+        max_bytes=0,
+        backup_count=5,
+        segment_writer=None,
+    ):
+        self.path = path
+        self.segment_writer = segment_writer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = None
+        self._file = None
+        self._writer = None
+
+        self._stats_lock = threading.Lock()
+        self.dropped = 0
+        self.written = 0
+        self.rotations = 0
+        self._reported_dropped = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def submit(self, row):
+        """Encolar una fila sin bloquear; devuelve False si se descartó"""
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except queue.Full:
+            with self._stats_lock:
+                self.dropped += 1
+            return False
+
+    def close(self, timeout=10):
+        """Detener el hilo tras vaciar la cola por completo"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        else:
+            self._flush_pending()
+        self._close_file()
+        if self.segment_writer is not None:
+            self.segment_writer.close()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "queued": self._queue.qsize(),
+                "written": self.written,
+                "dropped": self.dropped,
+                "rotations": self.rotations,
+            }
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._write_batch([])
+                continue
+            batch = [first]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write_batch(batch)
+
+    def _flush_pending(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        with self._stats_lock:
+            dropped = self.dropped
+        if dropped > self._reported_dropped:
+            batch.append(
+                (
+                    time.time(),
+                    "metrics_dropped",
+                    "-",
+                    "dropped",
+                    f"total={dropped}",
+                    "-",
+                    [],
+                    os.getpid(),
+                    threading.get_ident(),
+                )
+            )
+            self._reported_dropped = dropped
+
+        if self.segment_writer is not None:
+            try:
+                # Aun sin filas: así se escribe el bloque pendiente que venció
+                self.segment_writer.write_batch(batch)
+            except Exception as e:
+                print(f"[VALIDADOR] [METRICS] Error writing segment: {e}")
+                self.segment_writer.close()
+
+        if not batch:
+            return
+
+        if self.path is not None:
+            try:
+                self._open_file()
+                self._writer.writerows(format_row(row) for row in batch)
+                self._file.flush()
+            except Exception as e:
+                print(f"[VALIDADOR] [METRICS] Error writing metrics: {e}")
+                self._close_file()
+                return
+
+            if self.max_bytes > 0 and self._file.tell() >= self.max_bytes:
+                self._rotate()
+
+        with self._stats_lock:
+            self.written += len(batch)
+
+    def _open_file(self):
+        if self._file is not None:
+            return
+        self._file = open(self.path, "a", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file)
+        # Encabezados solo si el archivo es nuevo
+        if self._file.tell() == 0:
+            self._writer.writerow(METRICS_COLUMNS)
+
+    def _close_file(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            finally:
+                self._file = None
+                self._writer = None
+
+    def _rotate(self):
+        self._close_file()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        with self._stats_lock:
+            self.rotations += 1
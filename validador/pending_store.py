@@ -0,0 +1,91 @@
+import threading
+import time
+
+
+class StoreFull(Exception):
+    """No hay lugar para otra request pendiente"""
+
+
+class PendingStore:
+    """Requests en espera por request_id, acotadas y con vencimiento.
+
+    Cada entrada se registra con un deadline absoluto. El hilo HTTP la quita
+    al terminar; si no lo hace (error, hilo muerto), el barrido de fondo la
+    elimina `grace` segundos después del deadline. Las respuestas que llegan
+    sin entrada (después del timeout o tras el consenso) no se guardan: solo
+    se cuentan como tardías.
+    """
+
+    def __init__(self, max_entries=10000, grace=2.0, sweep_interval=1.0):
+        self.max_entries = max_entries
+        self.grace = grace
+        self.sweep_interval = sweep_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.registered = 0
+        self.completed = 0
+        self.expired = 0
+        self.rejected = 0
+        self.late_responses = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+
+    def register(self, request_id, pending, deadline):
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self.rejected += 1
+                raise StoreFull(f"{len(self._entries)} requests pending")
+            self._entries[request_id] = (deadline, pending)
+            self.registered += 1
+
+    def get(self, request_id):
+        entry = self._entries.get(request_id)
+        if entry is None:
+            with self._lock:
+                self.late_responses += 1
+            return None
+        return entry[1]
+
+    def remove(self, request_id):
+        with self._lock:
+            if self._entries.pop(request_id, None) is not None:
+                self.completed += 1
+
+    def sweep(self, now=None):
+        """Eliminar las entradas vencidas; devuelve cuántas se quitaron"""
+        limit = (now if now is not None else time.time()) - self.grace
+        with self._lock:
+            expired = [
+                rid for rid, (deadline, _) in self._entries.items() if deadline < limit
+            ]
+            for request_id in expired:
+                del self._entries[request_id]
+            self.expired += len(expired)
+        return len(expired)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "registered": self.registered,
+                "completed": self.completed,
+                "expired": self.expired,
+                "rejected": self.rejected,
+                "late_responses": self.late_responses,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _run(self):
+        while not self._stop.wait(self.sweep_interval):
+            self.sweep()
@@ -0,0 +1,139 @@
+"""Publisher confirms del fan-out de requests.
+
+Con el canal en modo confirm el broker contesta cada publicación con
+basic.ack (la tomó), basic.nack (la descartó) o, si se publicó con
+mandatory y ninguna cola la recibe, basic.return seguido del ack. Nada de
+eso se espera de forma sincrónica: el publicador anota el delivery tag de
+cada mensaje y los acks (a menudo `multiple`, uno por varios mensajes) se
+resuelven en lote al llegar.
+
+Un nack, un return o un mensaje que ni siquiera se pudo publicar (p. ej.
+un header que pika no codifica) falla ese destino enseguida, así la
+votación deja de esperar una respuesta que no va a llegar en lugar de
+agotar el timeout.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+NACKED = "nacked"
+RETURNED = "returned"
+CHANNEL_CLOSED = "channel_closed"
+UNPUBLISHABLE = "unpublishable"
+
+
+class FanoutConfirms:
+    """Confirmaciones pendientes del fan-out de una request.
+
+    on_failure(microservice_id, reason) se llama una vez por destino fallido
+    y on_complete(fanout) cuando todos los destinos quedaron resueltos; ambos
+    desde el hilo (o loop) del publicador.
+    """
+
+    def __init__(self, microservice_ids, on_failure, on_complete=None):
+        self.on_failure = on_failure
+        self.on_complete = on_complete
+        self.started = time.perf_counter()
+        self.outstanding = set(microservice_ids)
+        self.failed = {}
+        self._lock = threading.Lock()
+
+    def target(self, microservice_id):
+        """Confirmación de un destino, para pasar al transporte"""
+        return Confirm(self, microservice_id)
+
+    def settle(self, microservice_id, reason=None):
+        with self._lock:
+            if microservice_id not in self.outstanding:
+                # Ya resuelto: el ack que sigue a un basic.return
+                return
+            self.outstanding.discard(microservice_id)
+            if reason is not None:
+                self.failed[microservice_id] = reason
+            done = not self.outstanding
+        if reason is not None:
+            self.on_failure(microservice_id, reason)
+        if done and self.on_complete is not None:
+            self.on_complete(self)
+
+
+class Confirm:
+    """Un mensaje del fan-out: ack() al confirmarse, fail(reason) si no"""
+
+    __slots__ = ("fanout", "microservice_id")
+
+    def __init__(self, fanout, microservice_id):
+        self.fanout = fanout
+        self.microservice_id = microservice_id
+
+    def ack(self):
+        self.fanout.settle(self.microservice_id)
+
+    def fail(self, reason):
+        self.fanout.settle(self.microservice_id, reason)
+
+
+class ConfirmTracker:
+    """Delivery tags sin confirmar de un canal en modo confirm.
+
+    Solo se usa desde el hilo (o loop) de la conexión. Los tags los asigna el
+    broker en orden desde 1 por canal, así que se cuentan localmente; al
+    abrir un canal nuevo hay que llamar a reset().
+    """
+
+    def __init__(self):
+        self._next_tag = 0
+        self._unconfirmed = OrderedDict()
+        self._by_message = {}
+
+    def reset(self):
+        self._next_tag = 0
+        self._unconfirmed.clear()
+        self._by_message.clear()
+
+    def published(self, routing_key, properties, confirm=None):
+        """Anotar un basic_publish recién hecho en el canal"""
+        self._next_tag += 1
+        if confirm is None:
+            return
+        key = (getattr(properties, "correlation_id", None), routing_key)
+        self._unconfirmed[self._next_tag] = (key, confirm)
+        self._by_message[key] = self._next_tag
+
+    def confirmed(self, delivery_tag, multiple, ack):
+        """basic.ack o basic.nack; con multiple cubre todos los tags <= delivery_tag"""
+        if multiple:
+            tags = []
+            for tag in self._unconfirmed:
+                if tag > delivery_tag:
+                    break
+                tags.append(tag)
+        else:
+            tags = [delivery_tag] if delivery_tag in self._unconfirmed else []
+        for tag in tags:
+            key, confirm = self._unconfirmed.pop(tag)
+            self._by_message.pop(key, None)
+            if ack:
+                confirm.ack()
+            else:
+                confirm.fail(NACKED)
+
+    def returned(self, routing_key, properties):
+        """basic.return: el mensaje no llegó a ninguna cola"""
+        key = (getattr(properties, "correlation_id", None), routing_key)
+        tag = self._by_message.pop(key, None)
+        if tag is None:
+            return
+        _, confirm = self._unconfirmed.pop(tag)
+        confirm.fail(RETURNED)
+
+    def fail_all(self, reason=CHANNEL_CLOSED):
+        """El canal se cerró: lo no confirmado pudo perderse"""
+        pending = [confirm for _, confirm in self._unconfirmed.values()]
+        self.reset()
+        for confirm in pending:
+            confirm.fail(reason)
+
+    def __len__(self):
+        return len(self._unconfirmed)
@@ -0,0 +1,210 @@
+import json
+import os
+
+# Campos que cambian entre instancias y no cuentan para el voto
+IGNORED_FIELDS = ("microservice_id", "instance", "timestamp")
+
+
+def response_fingerprint(response):
+    """Huella canónica y barata de una respuesta, calculada una sola vez.
+
+    Equivale a comparar el JSON normalizado (sin microservice_id y sin
+    data.instance/data.timestamp) pero con tuplas en vez de json.dumps.
+    """
+    data = response.get("data", {})
+    try:
+        key = (
+            tuple(
+                sorted(
+                    (k, v)
+                    for k, v in response.items()
+                    if k not in IGNORED_FIELDS and k != "data"
+                )
+            ),
+            tuple(sorted((k, v) for k, v in data.items() if k not in IGNORED_FIELDS)),
+        )
+        hash(key)
+        return key
+    except TypeError:
+        # Valores no hashables (listas, dicts): caer al JSON ordenado
+        r = {k: v for k, v in response.items() if k not in IGNORED_FIELDS}
+        r["data"] = {k: v for k, v in data.items() if k not in IGNORED_FIELDS}
+        return json.dumps(r, sort_keys=True)
+
+
+class FirstKAgree:
+    """Decide en cuanto k instancias coinciden (k=2 es la regla original)"""
+
+    def __init__(self, k=2):
+        self.k = k
+
+    def weight(self, microservice_id):
+        return 1
+
+    def reached(self, weight, targets):
+        return weight >= self.k
+
+    def total(self, targets):
+        return len(targets)
+
+
+class MajorityOfN:
+    """Decide con más de la mitad de las instancias consultadas"""
+
+    def weight(self, microservice_id):
+        return 1
+
+    def reached(self, weight, targets):
+        return weight > len(targets) / 2
+
+    def total(self, targets):
+        return len(targets)
+
+
+class WeightedQuorum:
+    """Cada microservicio vota con su peso; decide con más de la mitad del
+    peso total de las instancias consultadas"""
+
+    def __init__(self, weights):
+        self.weights = weights
+
+    def weight(self, microservice_id):
+        return self.weights.get(int(microservice_id), 1)
+
+    def reached(self, weight, targets):
+        return weight > self.total(targets) / 2
+
+    def total(self, targets):
+        return sum(self.weight(ms) for ms in targets)
+
+
+def strategy_from_env():
+    """QUORUM_STRATEGY=first_k (QUORUM_K), majority o weighted (QUORUM_WEIGHTS=1:2,2:1,3:1)"""
+    name = os.getenv("QUORUM_STRATEGY", "first_k")
+    if name == "majority":
+        return MajorityOfN()
+    if name == "weighted":
+        weights = {}
+        for pair in os.getenv("QUORUM_WEIGHTS", "").split(","):
+            if pair.strip():
+                ms, weight = pair.split(":")
+                weights[int(ms)] = float(weight)
+        return WeightedQuorum(weights)
+    return FirstKAgree(int(os.getenv("QUORUM_K", "2")))
+
+
+class VoteTally:
+    """Conteo incremental de una request: cada respuesta se procesa una vez
+    al llegar y la decisión se toma en tiempo constante, sin recontar.
+
+    `targets` define el quorum; `dispatched` son las instancias a las que ya
+    se envió la consulta (con envío escalonado puede ser un subconjunto).
+    Las instancias en `excluded` (circuito abierto, deadline vencido) ya no
+    se esperan: si sin ellas ninguna respuesta puede llegar al quorum, la
+    votación termina sin decisión.
+    """
+
+    def __init__(self, targets, strategy, dispatched=None):
+        self.targets = list(targets)
+        self.dispatched = list(self.targets if dispatched is None else dispatched)
+        self.strategy = strategy
+        self.responses = []
+        self.responded = set()
+        self.excluded = set()
+        self.decision = None
+        self._weights = {}
+        self._first = {}
+
+    def add(self, response):
+        """Agregar {"microservice_id", "response"}; devuelve la decisión o None"""
+        self.responses.append(response)
+        self.responded.add(response["microservice_id"])
+        if self.decision is None:
+            key = response_fingerprint(response["response"])
+            weight = self._weights.get(key, 0) + self.strategy.weight(
+                response["microservice_id"]
+            )
+            self._weights[key] = weight
+            self._first.setdefault(key, response)
+            if self.strategy.reached(weight, self.targets):
+                self.decision = self._first[key]
+        return self.decision
+
+    def dispatch(self, microservice_ids):
+        self.dispatched.extend(microservice_ids)
+
+    def exclude(self, microservice_ids):
+        self.excluded.update(microservice_ids)
+
+    @property
+    def impossible(self):
+        """Sin decisión y ni con el voto de todas las que faltan se llega al quorum"""
+        if self.decision is not None:
+            return False
+        remaining = sum(
+            self.strategy.weight(ms)
+            for ms in self.targets
+            if ms not in self.responded and ms not in self.excluded
+        )
+        best = max(self._weights.values(), default=0)
+        return not self.strategy.reached(best + remaining, self.targets)
+
+    @property
+    def finished(self):
+        """Hay decisión, ya no puede haberla o respondieron todas las consultadas"""
+        return (
+            self.decision is not None
+            or len(self.responses) >= len(self.dispatched)
+            or self.impossible
+        )
+
+
+class BatchVoteTally:
+    """Un VoteTally por producto para /process/batch"""
+
+    def __init__(self, product_ids, targets, strategy, dispatched=None):
+        self.product_ids = list(product_ids)
+        self.targets = list(targets)
+        self.dispatched = list(self.targets if dispatched is None else dispatched)
+        self.responses = []
+        self.responded = set()
+        self.excluded = set()
+        self.decided = {}
+        self._tallies = {p: VoteTally(targets, strategy) for p in self.product_ids}
+
+    def add(self, response):
+        self.responses.append(response)
+        microservice_id = response["microservice_id"]
+        self.responded.add(microservice_id)
+        for tally in self._tallies.values():
+            # Una instancia que respondió sin algún producto tampoco lo votará
+            tally.responded.add(microservice_id)
+        for item in response["response"].get("data", {}).get("items", []):
+            product_id = item.get("product_id")
+            tally = self._tallies.get(product_id)
+            if tally is None or tally.decision is not None:
+                continue
+            decision = tally.add({"microservice_id": microservice_id, "response": item})
+            if decision is not None:
+                self.decided[product_id] = decision["response"]
+        return self.decided
+
+    def dispatch(self, microservice_ids):
+        self.dispatched.extend(microservice_ids)
+
+    def exclude(self, microservice_ids):
+        self.excluded.update(microservice_ids)
+        for tally in self._tallies.values():
+            tally.exclude(microservice_ids)
+
+    @property
+    def finished(self):
+        if len(self.decided) == len(self.product_ids) or len(self.responses) >= len(
+            self.dispatched
+        ):
+            return True
+        # Terminado si ningún producto pendiente puede llegar al quorum
+        return all(
+            tally.decision is not None or tally.impossible
+            for tally in self._tallies.values()
+        )